@@ -0,0 +1,139 @@
+import threading
+
+from handlers.config_handler import get_option
+from handlers.log_handler import create_logger
+
+log = create_logger(__name__)
+
+DEFAULT_API_BASE_URL = "https://puush.me/api"
+
+API_CLIENT = None
+API_CLIENT_LOCK = threading.Lock()
+
+
+class PuushApiClient:
+    """
+    HTTP client shared by all puush API calls.
+
+    Owns a single requests.Session with a pooled, keep-alive transport and transport-level retries,
+    so that consecutive requests reuse already established TCP+TLS connections.
+    """
+    def __init__(self, base_url: str = DEFAULT_API_BASE_URL, pool_size: int = 10, max_retries: int = 3,
+                 backoff_factor: float = 0.5, timeout: float = 30):
+        """
+        :param base_url:        URL that relative endpoints (starting with /) are resolved against.
+        :param pool_size:       Maximum amount of pooled connections per host.
+        :param max_retries:     Amount of transport-level retries (connection errors, and 5xx responses to GET/HEAD).
+        :param backoff_factor:  Exponential backoff factor between retries.
+        :param timeout:         Request timeout in seconds.
+        """
+        # requests takes a while to import, so only commands that actually make requests pay for it.
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+        # Only idempotent requests are retried here. A resent delete may find its entry already deleted,
+        # so POST requests are left to DeletionEngine, which knows how to handle that.
+        retry = Retry(total=max_retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=(500, 502, 503, 504),
+                      allowed_methods=frozenset(["GET", "HEAD"]),
+                      raise_on_status=False)
+
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry,
+                                   pool_block=True)
+
+        self.session = requests.Session()
+        self.session.headers.update({"Connection": "keep-alive"})
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+
+    def resolve_url(self, url: str):
+        """
+        :param url: Absolute URL, or endpoint relative to the base URL.
+        :return: Absolute URL.
+        """
+        if url.startswith("/"):
+            return self.base_url + url
+
+        return url
+
+    def post(self, url: str, data: dict = None, **kwargs):
+        """
+        Makes a HTTP POST request over the pooled session.
+        :param url:
+        :param data:
+        :param kwargs:  Passed on to requests.Session.post.
+        :return:
+        """
+        kwargs.setdefault("timeout", self.timeout)
+
+        return self.session.post(self.resolve_url(url), data=data, **kwargs)
+
+    def get(self, url: str, **kwargs):
+        """
+        Makes a HTTP GET request over the pooled session.
+        :param url:
+        :param kwargs:  Passed on to requests.Session.get.
+        :return:
+        """
+        kwargs.setdefault("timeout", self.timeout)
+
+        return self.session.get(self.resolve_url(url), **kwargs)
+
+    def connection_stats(self):
+        """
+        Summarise connection usage across all host pools.
+
+        Requests that did not need a new connection reused a pooled (keep-alive) one.
+        :return: dict with amount of requests, new connections and reused connections.
+        """
+        pools = self.adapter.poolmanager.pools
+        requests_sent = 0
+        connections = 0
+
+        for key in pools.keys():
+            pool = pools[key]
+            requests_sent += pool.num_requests
+            connections += pool.num_connections
+
+        return {"requests": requests_sent,
+                "connections": connections,
+                "reused": max(0, requests_sent - connections)}
+
+    def close(self):
+        self.session.close()
+
+
+def get_api_client():
+    """
+    Returns *the* (singular) API client, creating it from config on first use.
+    :return:
+    """
+    global API_CLIENT
+
+    with API_CLIENT_LOCK:
+        if API_CLIENT is None:
+            API_CLIENT = PuushApiClient(base_url=get_option("api_base_url", default=DEFAULT_API_BASE_URL),
+                                        pool_size=get_option("http_pool_size", default=10),
+                                        max_retries=get_option("http_max_retries", default=3),
+                                        backoff_factor=get_option("http_retry_backoff_factor", default=0.5),
+                                        timeout=get_option("http_timeout_seconds", default=30))
+
+    return API_CLIENT
+
+
+def reset_api_client():
+    """
+    Closes the API client, so that the next get_api_client() call creates a new one from (changed) config.
+    :return:
+    """
+    global API_CLIENT
+
+    with API_CLIENT_LOCK:
+        if API_CLIENT is not None:
+            API_CLIENT.close()
+            API_CLIENT = None
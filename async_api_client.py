@@ -0,0 +1,289 @@
+import asyncio
+import os
+import time
+
+import aiohttp
+
+from api_client import DEFAULT_API_BASE_URL
+
+from handlers.config_handler import get_option
+from handlers.log_handler import create_logger
+from handlers.rate_limit_handler import TokenBucket
+from metrics import METRICS
+from puush_api import AUTH_API, DELETED_ENTRIES_IDS, DELETION_API, HISTORY_API, NOT_FOUND_STATUS_CODE, \
+    THUMBNAIL_API, TRANSIENT_HTTP_STATUS_CODES, UPLOAD_API, PuushApiError, collect_entries, count_api_call, \
+    is_transient_error, raise_for_status_code, record_deletion
+from puush_entry import PuushEntry
+from response_parser import iter_history_entries, parse_auth_response, parse_upload_response, split_status
+from utils import logprint
+
+log = create_logger(__name__)
+
+def is_transient_async_error(exc: Exception):
+    """
+    Determines whether a failed async API request is worth retrying.
+    :param exc:
+    :return:
+    """
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status in TRANSIENT_HTTP_STATUS_CODES
+
+    return isinstance(exc, (aiohttp.ClientConnectionError, asyncio.TimeoutError)) or is_transient_error(exc)
+
+
+async def call_async(rate_limiter: TokenBucket, func, *args, max_retries: int = 0,
+                     is_retryable=is_transient_async_error):
+    """
+    Awaits an API coroutine function once the rate limiter allows it, retrying retryable errors
+    and reporting the outcome and latency back to the rate limiter, like DeletionEngine.call.
+    :param rate_limiter:
+    :param func:
+    :param args:
+    :param max_retries:
+    :param is_retryable:    Callable that decides whether an exception is worth retrying.
+    :return: Whatever func returns.
+    """
+    attempt = 0
+    name = getattr(func, "__name__", repr(func))
+
+    while True:
+        await rate_limiter.acquire_async()
+        started = time.monotonic()
+
+        try:
+            result = await func(*args)
+        except Exception as exc:
+            rate_limiter.on_failure()
+
+            if not is_retryable(exc) or attempt >= max_retries:
+                raise
+
+            attempt += 1
+            log.warning("Transient error in {}{} (attempt {}/{}), retrying: {}".format(
+                name, tuple(getattr(arg, "identifier", arg) for arg in args), attempt, max_retries, exc))
+
+            continue
+
+        rate_limiter.on_success(time.monotonic() - started)
+
+        return result
+
+
+class AsyncPuushApiClient:
+    """
+    asyncio client for the puush API.
+
+    A single aiohttp session with a pooled connector is shared by all requests, and a semaphore bounds the
+    amount of requests in flight, so one event loop can keep hundreds of requests going without a thread each.
+
+    Usage:
+        async with AsyncPuushApiClient() as client:
+            history = await client.get_history()
+    """
+    def __init__(self, api_key: str = None, concurrency: int = 100, timeout: float = 30, base_url: str = None):
+        """
+        :param api_key:     API key to authenticate with, defaults to the one in config.
+        :param base_url:    URL that relative endpoints are resolved against, defaults to api_base_url in config.
+        :param concurrency: Maximum amount of requests in flight.
+        :param timeout:     Request timeout in seconds.
+        """
+        self.api_key = api_key if api_key is not None else get_option("api_key")
+        if base_url is None:
+            base_url = get_option("api_base_url", default=DEFAULT_API_BASE_URL)
+        self.base_url = base_url.rstrip("/")
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.semaphore = None
+        self.session = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def open(self):
+        if self.session is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency),
+                                                 timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def post(self, url: str, data):
+        """
+        Makes a HTTP POST request, bounded by the concurrency limit.
+        :param url:
+        :param data:    Form fields dict, or aiohttp.FormData.
+        :return: Raw response body.
+        """
+        endpoint = url
+
+        if url.startswith("/"):
+            count_api_call(url)
+            url = self.base_url + url
+
+        async with self.semaphore:
+            started = time.monotonic()
+
+            async with self.session.post(url, data=data) as response:
+                if response.status >= 400:
+                    METRICS.observe_api_error("HTTP {}".format(response.status))
+                response.raise_for_status()
+                content = await response.read()
+
+            elapsed = time.monotonic() - started
+            METRICS.observe_request(endpoint, elapsed)
+            log.info("Received POST request response %s from %s in %.3fs", response.status, url, elapsed)
+
+        return content
+
+    async def post_status(self, url: str, data):
+        """
+        Makes a HTTP POST request to an API endpoint whose response starts with a status code line.
+        :param url:
+        :param data:
+        :return: (raw response body, offset of the first byte after the status line)
+        """
+        content = await self.post(url, data)
+        status_code, body_start = split_status(content)
+        raise_for_status_code(status_code)
+
+        return content, body_start
+
+    async def auth(self, email: str = None, password: str = None):
+        """
+        Authenticates with login credentials, or with the API key if no credentials are given.
+        :param email:
+        :param password:
+        :return: AuthInfo
+        """
+        if email is not None and password is not None:
+            data = {"e": email, "p": password}
+        else:
+            data = {"k": self.api_key}
+
+        status_code, auth_info = parse_auth_response((await self.post(AUTH_API, data)).decode('utf-8'))
+        raise_for_status_code(status_code)
+
+        return auth_info
+
+    async def get_history(self):
+        """
+        Puush History API request which returns up to 10 entries, if successful.
+        :return:
+        """
+        content, body_start = await self.post_status(HISTORY_API, {"k": self.api_key})
+
+        return collect_entries(iter_history_entries(content, body_start), api_key=self.api_key)
+
+    async def delete_puush_entry(self, entry: PuushEntry):
+        """
+        Puush Deletion API request which deletes a given PuushEntry and
+        returns an updated list of puush (history?) entries.
+        :param entry:
+        :return:
+        """
+        if entry.identifier is None:
+            raise Exception("PuushEntry identifier was None!")
+
+        logprint("Deleting Puush entry \"{name}\" (ID: {ident})...".format(name=entry.filename,
+                                                                           ident=entry.identifier))
+
+        # Prematurely update list of deleted entries' IDs, as it is used by collect_entries.
+        DELETED_ENTRIES_IDS.add(entry.identifier)
+
+        try:
+            content, body_start = await self.post_status(DELETION_API,
+                                                         {"k": self.api_key, "i": str(entry.identifier)})
+        except PuushApiError as exc:
+            if exc.status_code != NOT_FOUND_STATUS_CODE:
+                raise
+
+            # The entry was listed, so it's gone: most likely a resent delete whose first attempt went through.
+            log.warning("Puush entry %s was already deleted, assuming an earlier attempt succeeded.", entry.identifier)
+            content, body_start = b"", 0
+
+        record_deletion(entry.identifier, api_key=self.api_key)
+
+        return collect_entries(iter_history_entries(content, body_start), api_key=self.api_key)
+
+    async def get_thumbnail(self, identifier: int):
+        """
+        Fetches the 100x100 PNG thumbnail of an entry.
+        :param identifier:
+        :return: PNG bytes, or None if the API responded with nothing.
+        """
+        content = await self.post(THUMBNAIL_API, {"k": self.api_key, "i": str(identifier)})
+
+        return content if len(content) > 0 else None
+
+    async def upload(self, path: str, md5: str = None):
+        """
+        Uploads a file, streaming it from disk.
+        :param path:
+        :param md5:     MD5 hex digest of the file, which makes the server verify the upload.
+        :return: UploadResult
+        """
+        with open(path, 'rb') as f:
+            data = aiohttp.FormData()
+            data.add_field("k", self.api_key)
+            data.add_field("z", "poop")
+            if md5 is not None:
+                data.add_field("c", md5)
+            data.add_field("f", f, filename=os.path.basename(path))
+
+            status_code, result = parse_upload_response((await self.post(UPLOAD_API, data)).decode('utf-8'))
+
+        raise_for_status_code(status_code)
+
+        return result
+
+    async def delete_entries(self, entries: list, rate_limiter: TokenBucket, max_retries: int = 0, on_deleted=None):
+        """
+        Deletes entries concurrently, paced by the rate limiter and retrying transient errors.
+        :param entries:
+        :param rate_limiter:
+        :param max_retries:
+        :param on_deleted:      Called with every entry as soon as it is deleted.
+        :return: List of (entry, updated history) tuples.
+        """
+        async def delete(entry):
+            result = await call_async(rate_limiter, self.delete_puush_entry, entry, max_retries=max_retries)
+
+            if on_deleted is not None:
+                on_deleted(entry)
+
+            return entry, result
+
+        return await asyncio.gather(*(delete(entry) for entry in entries))
+
+
+async def delete_history(rate_limiter: TokenBucket, max_retries: int = 0, api_key: str = None, on_deleted=None):
+    """
+    Deletes entries listed by the history API until the history is empty, using the asyncio client.
+    :param rate_limiter:    Paces (and retries) the history requests as well as the deletions.
+    :param max_retries:
+    :param api_key:
+    :param on_deleted:      Called with every entry as soon as it is deleted, so that a failed run can still tell
+                            how much it deleted.
+    :return: Amount of deleted entries.
+    """
+    deleted = 0
+
+    async with AsyncPuushApiClient(api_key=api_key, concurrency=get_option("async_concurrency", default=100),
+                                   timeout=get_option("http_timeout_seconds", default=30)) as client:
+        while True:
+            history_entries = await call_async(rate_limiter, client.get_history, max_retries=max_retries)
+
+            if len(history_entries) == 0:
+                break
+
+            deleted += len(await client.delete_entries(history_entries, rate_limiter, max_retries=max_retries,
+                                                       on_deleted=on_deleted))
+
+    return deleted
@@ -0,0 +1,188 @@
+"""
+End-to-end deletion throughput benchmark, run offline against the local mock puush server.
+
+Reports deletions per second, p50/p99 deletion request latency, API calls per deletion
+and memory use for accounts of different sizes.
+
+The mock server runs in a process of its own, so that memory is the client's alone, and a fixed fraction
+of every account is deleted, so that the work measured scales with the account size.
+
+Usage:
+    python benchmarks/throughput.py --sizes 10000 100000 1000000 --delete-fraction 0.1
+"""
+import argparse
+import contextlib
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+# Make the project root importable when run as a script.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api_client import get_api_client, reset_api_client  # noqa: E402
+from deletion_engine import DeletionEngine  # noqa: E402
+from handlers.config_handler import set_custom_config_options  # noqa: E402
+from handlers.log_handler import init_logging  # noqa: E402
+from handlers.rate_limit_handler import TokenBucket  # noqa: E402
+from main import delete_history, delete_history_pipelined  # noqa: E402
+from puush_api import API_CALL_COUNTS, DELETED_ENTRIES_IDS, delete_puush_entry, get_history, \
+    is_transient_error  # noqa: E402
+
+MOCK_SERVER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "mock_server.py")
+
+
+MODES = {"batch": delete_history,
+         "pipeline": delete_history_pipelined}
+
+
+def percentile(values: list, fraction: float):
+    """
+    :param values:      Sorted values.
+    :param fraction:    0-1
+    :return:
+    """
+    if len(values) == 0:
+        return 0.0
+
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def timed(func, latencies: list):
+    """
+    Wraps a function so that the duration of every call is appended to latencies.
+    :param func:
+    :param latencies:
+    :return:
+    """
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - started)
+
+    return wrapper
+
+
+@contextlib.contextmanager
+def mock_server_process(size: int, args):
+    """
+    Runs the mock server in a subprocess, so that its accounts don't count towards the client's memory.
+    :param size:
+    :param args:
+    :return: Context manager yielding the mock's API base URL.
+    """
+    process = subprocess.Popen([sys.executable, "-u", MOCK_SERVER_PATH, "--port", "0", "--entries", str(size),
+                                "--latency", str(args.latency), "--error-rate", str(args.error_rate),
+                                "--reappear-rate", str(args.reappear_rate)],
+                               stdout=subprocess.PIPE, universal_newlines=True)
+
+    try:
+        # "Serving mock puush API on <api base url> (...)"
+        yield process.stdout.readline().split()[5]
+    finally:
+        process.terminate()
+        process.wait()
+        process.stdout.close()
+
+
+def run_benchmark(size: int, args):
+    """
+    Runs one benchmark against a fresh mock account of `size` entries.
+    :param size:
+    :param args:
+    :return: dict of results.
+    """
+    with mock_server_process(size, args) as api_base_url:
+        set_custom_config_options({"api_base_url": api_base_url, "api_key": "benchmark-{}".format(size),
+                                   "journal_enabled": False})
+        reset_api_client()
+        DELETED_ENTRIES_IDS.clear()
+
+        # Create the account up front, so its setup isn't measured.
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            get_history()
+
+        API_CALL_COUNTS.clear()
+        max_deletions = int(size * args.delete_fraction)
+        if args.max_deletions is not None:
+            max_deletions = min(max_deletions, args.max_deletions)
+
+        latencies = []
+        rate_limiter = TokenBucket(args.rate, args.burst)
+
+        if args.trace_memory:
+            tracemalloc.start()
+
+        started = time.perf_counter()
+
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            with DeletionEngine(timed(delete_puush_entry, latencies), rate_limiter, workers=args.workers,
+                                is_transient=is_transient_error, max_retries=args.max_retries) as engine:
+                deleted = MODES[args.mode](engine, max_deletions=max_deletions)
+
+        elapsed = time.perf_counter() - started
+
+        peak_memory = None
+        if args.trace_memory:
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        latencies.sort()
+
+        return {"size": size,
+                "deleted": deleted,
+                "elapsed": elapsed,
+                "rate": deleted / elapsed if elapsed > 0 else 0,
+                "p50": percentile(latencies, 0.50),
+                "p99": percentile(latencies, 0.99),
+                "calls_per_deletion": sum(API_CALL_COUNTS.values()) / deleted if deleted > 0 else 0,
+                "connections": get_api_client().connection_stats()["connections"],
+                "peak_memory": peak_memory,
+                "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def print_results(results: list):
+    print("{:>9} {:>8} {:>9} {:>10} {:>9} {:>9} {:>11} {:>6} {:>12} {:>12}".format(
+        "entries", "deleted", "seconds", "deleted/s", "p50 ms", "p99 ms", "calls/del", "conns", "peak MiB",
+        "max RSS MiB"))
+
+    for result in results:
+        print("{size:>9} {deleted:>8} {elapsed:>9.2f} {rate:>10.1f} {p50_ms:>9.2f} {p99_ms:>9.2f} "
+              "{calls_per_deletion:>11.2f} {connections:>6} {peak:>12} {rss:>12.1f}".format(
+                p50_ms=result["p50"] * 1000, p99_ms=result["p99"] * 1000,
+                peak="-" if result["peak_memory"] is None else "{:.1f}".format(result["peak_memory"] / 2 ** 20),
+                rss=result["max_rss"] / 1024, **result))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Deletion throughput benchmark against a local mock puush server.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000],
+                        help="Account sizes (entries) to benchmark.")
+    parser.add_argument("--delete-fraction", type=float, default=0.1,
+                        help="Fraction of each account to delete, so that the work scales with the account size.")
+    parser.add_argument("--max-deletions", type=int, default=None,
+                        help="Caps the deletions per benchmark run, at the expense of comparable memory use.")
+    parser.add_argument("--mode", choices=list(MODES.keys()), default="batch", help="Deletion loop to benchmark.")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=100000, help="Rate limit in requests per second.")
+    parser.add_argument("--burst", type=int, default=100)
+    parser.add_argument("--max-retries", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.005, help="Injected server latency in seconds.")
+    parser.add_argument("--error-rate", type=float, default=0, help="Injected -1 failure rate.")
+    parser.add_argument("--reappear-rate", type=float, default=0,
+                        help="Chance of deleted entries reappearing in history responses.")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Report peak Python memory of each run with tracemalloc (slows the run down). "
+                             "Max RSS is the high-water mark of all runs so far, so sizes are run in ascending order.")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    init_logging()
+    print_results([run_benchmark(size, arguments) for size in sorted(arguments.sizes)])
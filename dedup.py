@@ -0,0 +1,160 @@
+import hashlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from api_client import get_api_client
+from deletion_engine import DeletionEngine
+from handlers.db_handler import get_journal
+from handlers.log_handler import create_logger
+from puush_api import DELETED_ENTRIES_IDS, SKIPPED_ENTRIES_IDS, delete_puush_entry, get_history
+from puush_entry import PuushEntry
+from sync import known_entries
+from thumbnail_cache import get_thumbnail_cache
+from utils import logprint
+
+log = create_logger(__name__)
+
+# Indexed for entries without a thumbnail, so that they aren't asked for one again.
+NO_THUMBNAIL = ""
+
+
+def thumbnail_hash(entry: PuushEntry):
+    """
+    :param entry:
+    :return: SHA-256 hex digest of the entry's thumbnail, or NO_THUMBNAIL.
+    """
+    thumbnail = get_thumbnail_cache().get(entry.identifier)
+
+    return hashlib.sha256(thumbnail).hexdigest() if thumbnail is not None else NO_THUMBNAIL
+
+
+def content_hash(entry: PuushEntry, chunk_size: int = 64 * 1024):
+    """
+    Hashes an entry's file as it is streamed, without holding it in memory.
+    :param entry:
+    :param chunk_size:
+    :return: SHA-256 hex digest of the entry's file.
+    """
+    digest = hashlib.sha256()
+
+    with get_api_client().get(entry.url, stream=True) as response:
+        response.raise_for_status()
+
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def group_by(entries, hashes: dict):
+    """
+    :param entries:
+    :param hashes:  dict of identifier: hash.
+    :return: Lists of entries sharing a hash, for hashes shared by more than one entry.
+    """
+    groups = defaultdict(list)
+
+    for entry in entries:
+        if entry.identifier in hashes:
+            groups[hashes[entry.identifier]].append(entry)
+
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def index_hashes(kind: str, entries: list, fetch):
+    """
+    Looks up hashes in the on-disk index, and fetches (then indexes) the missing ones.
+    :param kind:    "thumbnail" or "content".
+    :param entries:
+    :param fetch:   Callable that takes a list of entries and returns a dict of identifier: hash.
+    :return: dict of identifier: hash.
+    """
+    journal = get_journal()
+    hashes = journal.hashes(kind, (entry.identifier for entry in entries)) if journal is not None else {}
+    missing = [entry for entry in entries if entry.identifier not in hashes]
+
+    log.info("%d of %d %s hashes indexed, fetching %d.", len(hashes), len(entries), kind, len(missing))
+
+    if len(missing) > 0:
+        fetched = fetch(missing)
+        hashes.update(fetched)
+
+        if journal is not None:
+            journal.record_hashes(kind, fetched)
+
+    return hashes
+
+
+def find_duplicates(engine: DeletionEngine, entries: list, thumbnails: bool = True):
+    """
+    Groups entries by the hash of their content.
+
+    Thumbnails are tiny compared to the files, so (if enabled) they are compared first,
+    and only files whose thumbnail matches another one's are downloaded and hashed.
+    Entries without a thumbnail (files that aren't images) can't be pre-filtered, and are all hashed.
+    :param engine:      Rate limits (and retries) thumbnail requests, which go through the API.
+    :param entries:
+    :param thumbnails:  Pre-filter by thumbnail.
+    :return: Lists of entries with identical content.
+    """
+    entries = [entry for entry in entries if entry.url is not None]
+
+    if thumbnails:
+        thumbnail_hashes = index_hashes("thumbnail", entries, lambda missing: {
+            entry.identifier: result for entry, result in engine.map(thumbnail_hash, missing)})
+
+        candidates = [entry for entry in entries if thumbnail_hashes.get(entry.identifier) == NO_THUMBNAIL]
+        candidates += [entry for group in group_by(entries, thumbnail_hashes) for entry in group
+                       if thumbnail_hashes[entry.identifier] != NO_THUMBNAIL]
+    else:
+        candidates = entries
+
+    logprint("Hashing the content of {} of {} entries...".format(len(candidates), len(entries)))
+
+    def try_content_hash(entry):
+        try:
+            return content_hash(entry)
+        except Exception as exc:
+            log.warning("Hashing the content of %s failed, leaving it alone: %s", entry.identifier, exc)
+
+    def fetch_content_hashes(missing):
+        # File downloads don't go through the API, so they're only bounded by the amount of workers.
+        with ThreadPoolExecutor(max_workers=engine.workers, thread_name_prefix="hasher") as executor:
+            digests = executor.map(try_content_hash, missing)
+
+            return {entry.identifier: digest for entry, digest in zip(missing, digests) if digest is not None}
+
+    return group_by(candidates, index_hashes("content", candidates, fetch_content_hashes))
+
+
+def deduplicate(engine: DeletionEngine, list_func=get_history, thumbnails: bool = True):
+    """
+    Deletes all but the oldest (lowest ID) of every set of entries with identical content.
+
+    The history API only lists the newest entries, so the entries journaled by previous runs are checked as well.
+    :param engine:
+    :param list_func:   See known_entries.
+    :param thumbnails:  Pre-filter by thumbnail.
+    :return: Amount of deleted entries.
+    """
+    journal = get_journal()
+    if journal is not None:
+        DELETED_ENTRIES_IDS.update(journal.deleted_ids())
+
+    entries = known_entries(list_func)
+
+    entries.discard_all(DELETED_ENTRIES_IDS)
+    entries.discard_all(SKIPPED_ENTRIES_IDS)
+
+    duplicates = []
+    for group in find_duplicates(engine, list(entries), thumbnails=thumbnails):
+        group.sort(key=lambda entry: entry.identifier)
+        log.info("Keeping %s, deleting its duplicates %s", group[0].identifier,
+                 [entry.identifier for entry in group[1:]])
+        duplicates += group[1:]
+
+    logprint("Found {} duplicates of {} entries.".format(len(duplicates), len(entries)))
+
+    results = engine.delete_entries(duplicates, delete_func=delete_puush_entry)
+
+    return sum(1 for entry, updated_history in results if updated_history is not None)
@@ -0,0 +1,366 @@
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, CancelledError, Future, ThreadPoolExecutor, as_completed, wait
+from functools import partial
+
+from handlers.log_handler import create_logger
+from handlers.rate_limit_handler import TokenBucket
+from id_index import IdSet
+from tracing import SPAN_HOOKS, emit_span, span
+
+log = create_logger(__name__)
+
+
+class DeletionEngine:
+    """
+    Deletes PuushEntry objects concurrently on a bounded worker pool.
+
+    Every deletion takes a token from the shared rate limiter before it is sent,
+    so the amount of in-flight requests is bounded by `workers`, while the
+    request rate is bounded by the rate limiter. The outcome and latency of every
+    deletion is reported back to the rate limiter, and transient failures are retried.
+
+    Entries can be prepared (e.g. backed up) on a separate pool before they are deleted, so that slow preparation
+    neither holds a deletion worker or rate limiter token, nor counts towards the latency the rate is adapted to.
+    """
+    def __init__(self, delete_func, rate_limiter: TokenBucket, workers: int = 1, is_transient=None,
+                 max_retries: int = 0, prepare=None, prepare_workers: int = None):
+        """
+        :param delete_func:     Callable that deletes a single PuushEntry, e.g. delete_puush_entry.
+        :param rate_limiter:    Rate limiter shared by all workers.
+        :param workers:         Maximum amount of concurrent deletion requests.
+        :param is_transient:    Callable that decides whether an exception is worth retrying.
+        :param max_retries:     Amount of retries per deletion on transient errors.
+        :param prepare:         Callable run for every entry before it is deleted, e.g. Downloader.confirm.
+                                Entries it returns False for are skipped, with a result of None.
+        :param prepare_workers: Maximum amount of concurrently prepared entries, defaults to workers.
+        """
+        if workers < 1:
+            raise ValueError("DeletionEngine needs at least 1 worker, got {}!".format(workers))
+
+        self.delete_func = delete_func
+        self.rate_limiter = rate_limiter
+        self.workers = workers
+        self.is_transient = is_transient
+        self.max_retries = max_retries
+        self.prepare = prepare
+        self.prepare_workers = prepare_workers if prepare_workers is not None else workers
+        self.executor = None
+        self.prepare_executor = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # Don't wait for queued deletions if we're bailing out due to an exception.
+        self.shutdown(wait=exc_type is None)
+
+    def start(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="deleter")
+
+        if self.prepare is not None and self.prepare_executor is None:
+            self.prepare_executor = ThreadPoolExecutor(max_workers=self.prepare_workers, thread_name_prefix="preparer")
+
+    def shutdown(self, wait=True):
+        # Prepared entries are handed to the deletion workers, so stop preparing first.
+        if self.prepare_executor is not None:
+            self.prepare_executor.shutdown(wait=wait, cancel_futures=not wait)
+            self.prepare_executor = None
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait, cancel_futures=not wait)
+            self.executor = None
+
+    def call(self, func, *args):
+        """
+        Calls an API function once the rate limiter allows it, retrying transient errors
+        and reporting the outcome and latency back to the rate limiter.
+        :param func:
+        :param args:
+        :return: Whatever func returns.
+        """
+        attempt = 0
+        name = getattr(func, "__name__", repr(func))
+
+        while True:
+            throttled = time.perf_counter()
+            waited = self.rate_limiter.acquire()
+            log.debug2("Rate limiter delayed %s by %.3fs", name, waited)
+
+            if SPAN_HOOKS and waited > 0:
+                emit_span("throttle", "throttle", throttled, waited, {"call": name})
+
+            started = time.monotonic()
+            try:
+                with span(name, "call", attempt=attempt):
+                    result = func(*args)
+            except Exception as exc:
+                self.rate_limiter.on_failure()
+
+                if self.is_transient is None or not self.is_transient(exc) or attempt >= self.max_retries:
+                    raise
+
+                attempt += 1
+                log.warning("Transient error in {}{} (attempt {}/{}), retrying: {}".format(
+                    name, tuple(getattr(arg, "identifier", arg) for arg in args), attempt, self.max_retries, exc))
+
+                continue
+
+            self.rate_limiter.on_success(time.monotonic() - started)
+
+            return result
+
+    def _delete(self, entry, delete_func):
+        """
+        Wait for the rate limiter, then delete the entry.
+        :param entry:
+        :param delete_func:
+        :return:
+        """
+        return self.call(delete_func, entry)
+
+    def submit_delete(self, delete_func, entry):
+        """
+        Deletes an entry on a worker (see call), once it has been prepared.
+        :param delete_func:
+        :param entry:
+        :return: Future of the deletion's result, None if the entry was skipped.
+        """
+        if self.prepare is None:
+            return self.executor.submit(self._delete, entry, delete_func)
+
+        result = Future()
+
+        def forward(future):
+            if future.cancelled():
+                result.set_exception(CancelledError())
+            elif future.exception() is not None:
+                result.set_exception(future.exception())
+            else:
+                result.set_result(future.result())
+
+        def prepared(future):
+            if not result.set_running_or_notify_cancel():
+                return
+
+            try:
+                if not future.result():
+                    result.set_result(None)
+                    return
+
+                self.executor.submit(self._delete, entry, delete_func).add_done_callback(forward)
+            except Exception as exc:
+                result.set_exception(exc)
+
+        self.prepare_executor.submit(self.prepare, entry).add_done_callback(prepared)
+
+        return result
+
+    def map(self, func, items: list, submit=None):
+        """
+        Calls an API function for a batch of items concurrently (see call) and waits for all of them to finish.
+
+        If any call fails the remaining queued calls are cancelled and the exception is re-raised.
+        :param func:
+        :param items:
+        :param submit:  Callable taking (func, item) that submits a call and returns its Future,
+                        defaults to calling it on a worker.
+        :return: List of (item, result) tuples in completion order.
+        """
+        self.start()
+
+        if submit is None:
+            submit = partial(self.executor.submit, self.call)
+
+        with span("batch", "deletion", func=getattr(func, "__name__", repr(func)), items=len(items)):
+            futures = {submit(func, item): item for item in items}
+            results = []
+
+            try:
+                for future in as_completed(futures):
+                    results.append((futures[future], future.result()))
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
+
+            return results
+
+    def delete_entries(self, entries: list, delete_func=None):
+        """
+        Delete a batch of entries concurrently and wait for all of them to finish.
+
+        If any deletion fails the remaining queued deletions are cancelled and the exception is re-raised.
+        :param entries:
+        :param delete_func: Overrides the engine's delete function for this batch.
+        :return: List of (entry, result) tuples in completion order.
+        """
+        return self.map(delete_func if delete_func is not None else self.delete_func, entries,
+                        submit=self.submit_delete)
+
+
+class PipelinedDeleter:
+    """
+    Overlaps listing entries with deleting them (producer/consumer).
+
+    A prefetcher thread keeps a bounded queue of candidate entries topped up from the list function,
+    de-duplicated against entries that are already queued, in flight or excluded, while the engine's
+    workers drain the queue. The deleters therefore never sit idle waiting for a listing round trip.
+
+    Results of the delete function that are lists of entries (updated histories) are queued as well,
+    so the list function is only called when those don't keep the queue filled.
+    """
+    # Queued by the prefetcher once there is nothing left to delete (or it failed).
+    DONE = object()
+
+    def __init__(self, engine: DeletionEngine, list_func, is_excluded=None, queue_size: int = 50):
+        """
+        :param engine:      DeletionEngine whose workers, rate limiter and retries are used.
+        :param list_func:   Callable returning the current candidate entries, e.g. get_history.
+        :param is_excluded: Callable deciding whether an entry must not be deleted (e.g. already deleted).
+        :param queue_size:  Maximum amount of prefetched entries waiting for a worker.
+        """
+        self.engine = engine
+        self.list_func = list_func
+        self.is_excluded = is_excluded
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.claimed_ids = IdSet()
+        self.in_flight = 0
+        self.progress = threading.Condition()
+        self.stopping = threading.Event()
+        self.prefetch_error = None
+
+    def _offer(self, entries, block: bool = True):
+        """
+        Queues entries that haven't been claimed yet.
+        :param entries:
+        :param block:   Wait for room in the queue, otherwise entries that don't fit are left for a later listing.
+        :return: Amount of queued entries.
+        """
+        queued = 0
+
+        for entry in entries:
+            if self.is_excluded is not None and self.is_excluded(entry):
+                continue
+
+            with self.progress:
+                if entry.identifier in self.claimed_ids:
+                    continue
+
+                self.claimed_ids.add(entry.identifier)
+                self.in_flight += 1
+
+            try:
+                # Blocks while the queue is full, so listing never runs far ahead of deleting.
+                self.queue.put(entry, block=block)
+                queued += 1
+            except queue.Full:
+                with self.progress:
+                    self.claimed_ids.discard(entry.identifier)
+                    self.in_flight -= 1
+
+        return queued
+
+    def _prefetch(self):
+        try:
+            while not self.stopping.is_set():
+                # Deletion responses keep the queue topped up, only list when they can't keep up.
+                with self.progress:
+                    while self.queue.qsize() >= self.engine.workers and not self.stopping.is_set():
+                        self.progress.wait(timeout=1)
+
+                entries = self.engine.call(self.list_func)
+                queued = self._offer(entries)
+
+                if queued == 0:
+                    with self.progress:
+                        if self.in_flight == 0:
+                            # Nothing new listed, and nothing pending that could still fail and reappear.
+                            if len(entries) > 0:
+                                log.warning("Only entries that were already attempted are left, stopping.")
+                            break
+
+                        # Everything listed is already being taken care of, wait for a deletion to finish.
+                        self.progress.wait(timeout=1)
+
+                    continue
+
+                log.debug2("Prefetched %d entries", queued)
+        except Exception as exc:
+            self.prefetch_error = exc
+        finally:
+            self.queue.put(self.DONE)
+
+    def _finished(self, future):
+        # Deletion responses carry an updated history, feed it into the queue for free.
+        if not future.cancelled() and future.exception() is None and isinstance(future.result(), list):
+            self._offer(future.result(), block=False)
+
+        with self.progress:
+            self.in_flight -= 1
+            self.progress.notify_all()
+
+    def run(self, delete_func=None, max_deletions: int = None):
+        """
+        Deletes entries until the list function returns nothing more to delete.
+        :param delete_func:     Overrides the engine's delete function.
+        :param max_deletions:   Stop after this many deletions.
+        :return: List of (entry, result) tuples in completion order.
+        """
+        self.engine.start()
+
+        if delete_func is None:
+            delete_func = self.engine.delete_func
+
+        prefetcher = threading.Thread(target=self._prefetch, name="prefetcher", daemon=True)
+        prefetcher.start()
+
+        futures = {}
+        results = []
+
+        def collect(done):
+            for future in done:
+                results.append((futures.pop(future), future.result()))
+
+        try:
+            while max_deletions is None or len(results) + len(futures) < max_deletions:
+                entry = self.queue.get()
+
+                if entry is self.DONE:
+                    break
+
+                # Let the prefetcher know there is room in the queue.
+                with self.progress:
+                    self.progress.notify_all()
+
+                # Keep at most one request in flight per worker, the rest waits in the queue.
+                while len(futures) >= self.engine.workers:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    collect(done)
+
+                future = self.engine.submit_delete(delete_func, entry)
+                future.add_done_callback(self._finished)
+                futures[future] = entry
+
+            collect(wait(futures).done)
+        finally:
+            self.stopping.set()
+
+            # Unblock the prefetcher if it is waiting for room in the queue.
+            while prefetcher.is_alive():
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+                prefetcher.join(timeout=0.1)
+
+            for future in futures:
+                future.cancel()
+
+        if self.prefetch_error is not None:
+            raise self.prefetch_error
+
+        return results
@@ -0,0 +1,200 @@
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from api_client import get_api_client
+from handlers.log_handler import create_logger
+from metrics import METRICS
+from puush_api import SKIPPED_ENTRIES_IDS
+from puush_entry import PuushEntry
+from thumbnail_cache import get_thumbnail_cache
+from utils import logprint, logprint_error
+
+log = create_logger(__name__)
+
+UNSAFE_FILENAME_CHARACTERS = re.compile(r'[\\/:*?"<>|\0]')
+
+
+def remote_size(url: str):
+    """
+    :param url:
+    :return: Size in bytes as reported by the server, or None if unknown.
+    """
+    response = get_api_client().session.head(url, allow_redirects=True, timeout=get_api_client().timeout)
+    response.raise_for_status()
+
+    length = response.headers.get("Content-Length")
+
+    return int(length) if length is not None else None
+
+
+class Downloader:
+    """
+    Mirrors the files (and optionally thumbnails) of entries to disk through the pooled API client.
+
+    Bodies are streamed to disk in chunks, interrupted downloads are resumed with range requests,
+    and files whose size already matches the remote size are skipped.
+    """
+    def __init__(self, destination: str, workers: int = 4, chunk_size: int = 64 * 1024, max_retries: int = 3,
+                 thumbnails: bool = False, call_api=None):
+        """
+        :param destination: Directory to download files into.
+        :param workers:     Maximum amount of concurrent downloads.
+        :param chunk_size:  Bytes read from the response per write.
+        :param max_retries: Attempts per file after the first one fails.
+        :param thumbnails:  Also download each entry's /api/thumb thumbnail.
+        :param call_api:    Calls an API function with arguments, e.g. DeletionEngine.call, so that thumbnail
+                            requests are rate limited and retried like any other API request. Files are
+                            downloaded from the file host instead, and aren't.
+        """
+        self.destination = destination
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.thumbnails = thumbnails
+        self.call_api = call_api
+
+        os.makedirs(destination, exist_ok=True)
+
+    def path_for(self, entry: PuushEntry, suffix: str = ""):
+        filename = UNSAFE_FILENAME_CHARACTERS.sub("_", entry.filename or "")
+
+        return os.path.join(self.destination, "{}{}-{}".format(entry.identifier, suffix, filename))
+
+    def _fetch(self, entry: PuushEntry, path: str, expected_size):
+        """
+        Streams the file to disk, resuming from whatever is already on disk.
+        :param entry:
+        :param path:
+        :param expected_size:
+        :return: Size of the file on disk.
+        """
+        offset = os.path.getsize(path) if os.path.isfile(path) else 0
+        headers = {"Range": "bytes={}-".format(offset)} if offset > 0 else {}
+
+        with get_api_client().get(entry.url, headers=headers, stream=True) as response:
+            if response.status_code == 416:
+                # Nothing left to fetch, the file is already complete.
+                return offset
+
+            response.raise_for_status()
+
+            # Servers that ignore the range send the whole file again.
+            mode = 'ab' if response.status_code == 206 else 'wb'
+
+            with open(path, mode) as f:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+
+        return os.path.getsize(path)
+
+    def download_file(self, entry: PuushEntry):
+        """
+        Downloads an entry's file, retrying (and resuming) on failure.
+        :param entry:
+        :return: True if the file on disk is confirmed complete.
+        """
+        path = self.path_for(entry)
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                expected_size = remote_size(entry.url)
+
+                if expected_size is not None and os.path.isfile(path) and os.path.getsize(path) == expected_size:
+                    log.debug("Skipping download of {}, size already matches.".format(entry.identifier))
+                    return True
+
+                if expected_size is not None and os.path.isfile(path) and os.path.getsize(path) > expected_size:
+                    # Local file is not a prefix of the remote one, start over.
+                    os.remove(path)
+
+                size = self._fetch(entry, path, expected_size)
+
+                if expected_size is None or size == expected_size:
+                    logprint("Downloaded {} ({} bytes) to {}".format(entry.identifier, size, path))
+                    return True
+
+                log.warning("Download of {} is {} of {} bytes, resuming.".format(entry.identifier, size,
+                                                                                  expected_size))
+            except Exception as exc:
+                log.warning("Download of {} failed (attempt {}/{}): {}".format(
+                    entry.identifier, attempt + 1, self.max_retries + 1, exc))
+
+        return False
+
+    def download_thumbnail(self, entry: PuushEntry):
+        """
+        Downloads an entry's 100x100 thumbnail.
+        :param entry:
+        :return: True if a thumbnail was saved.
+        """
+        path = self.path_for(entry, suffix="-thumb") + ".png"
+
+        if os.path.isfile(path) and os.path.getsize(path) > 0:
+            return True
+
+        thumbnail_cache = get_thumbnail_cache()
+
+        if self.call_api is not None and entry.identifier not in thumbnail_cache:
+            thumbnail = self.call_api(thumbnail_cache.get, entry.identifier)
+        else:
+            thumbnail = thumbnail_cache.get(entry.identifier)
+
+        # The API responds with nothing on failure.
+        if thumbnail is None:
+            return False
+
+        with open(path, 'wb') as f:
+            f.write(thumbnail)
+
+        return True
+
+    def download_entry(self, entry: PuushEntry):
+        """
+        Downloads an entry's file, and thumbnail if enabled.
+        :param entry:
+        :return: True if the download is confirmed.
+        """
+        if entry.url is None:
+            logprint_error("Cannot back up entry {}, its URL is unknown!".format(entry.identifier))
+            return False
+
+        if not self.download_file(entry):
+            return False
+
+        if self.thumbnails:
+            try:
+                if not self.download_thumbnail(entry):
+                    log.warning("No thumbnail available for {}".format(entry.identifier))
+            except Exception as exc:
+                log.warning("Thumbnail download of {} failed: {}".format(entry.identifier, exc))
+
+        return True
+
+    def download_entries(self, entries: list):
+        """
+        Downloads entries concurrently.
+        :param entries:
+        :return: List of entries whose download is confirmed.
+        """
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="downloader") as executor:
+            results = executor.map(self.download_entry, entries)
+
+            return [entry for entry, confirmed in zip(entries, results) if confirmed]
+
+    def confirm(self, entry: PuushEntry):
+        """
+        Backs up an entry before it is deleted, for use as DeletionEngine's prepare function.
+
+        Entries that fail to download are added to SKIPPED_ENTRIES_IDS instead, and left alone for the rest of the run.
+        :param entry:
+        :return: True if the entry may be deleted.
+        """
+        if not self.download_entry(entry):
+            logprint_error("NOT deleting entry {}, as it could not be backed up!".format(entry.identifier))
+            SKIPPED_ENTRIES_IDS.add(entry.identifier)
+            METRICS.observe_skip()
+
+            return False
+
+        return True
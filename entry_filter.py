@@ -0,0 +1,74 @@
+import fnmatch
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+from puush_entry import PuushEntry
+
+
+class EntryFilter(NamedTuple):
+    """
+    Predicates an entry must satisfy to be deleted, unset predicates always match.
+
+    Entries whose metadata is unknown (e.g. IDs walked by a sweep) never match a metadata predicate.
+    """
+    older_than: Optional[datetime] = None
+    max_views: Optional[int] = None
+    filename_glob: Optional[str] = None
+    min_size: Optional[int] = None
+    max_size: Optional[int] = None
+
+    def needs_metadata(self):
+        return self.older_than is not None or self.max_views is not None or self.filename_glob is not None \
+            or self.needs_size()
+
+    def needs_size(self):
+        return self.min_size is not None or self.max_size is not None
+
+    def matches_filename(self, filename: Optional[str]):
+        """
+        The journal matches filenames with this as well, SQLite's GLOB differs from fnmatch (e.g. [^x] vs [!x]).
+        :param filename:
+        :return:
+        """
+        if self.filename_glob is None:
+            return True
+
+        return filename is not None and fnmatch.fnmatch(filename, self.filename_glob)
+
+    def matches(self, entry: PuushEntry, size: int = None):
+        """
+        :param entry:
+        :param size:    Size of the entry's file in bytes, only required if a size predicate is set.
+        :return:
+        """
+        if self.older_than is not None and (entry.date is None or entry.date >= self.older_than):
+            return False
+
+        if self.max_views is not None and (entry.views is None or entry.views > self.max_views):
+            return False
+
+        if not self.matches_filename(entry.filename):
+            return False
+
+        if self.min_size is not None and (size is None or size < self.min_size):
+            return False
+
+        if self.max_size is not None and (size is None or size > self.max_size):
+            return False
+
+        return True
+
+    def to_dict(self):
+        filters = self._asdict()
+        if self.older_than is not None:
+            filters["older_than"] = self.older_than.isoformat()
+
+        return {key: value for key, value in filters.items() if value is not None}
+
+    @classmethod
+    def from_dict(cls, filters: dict):
+        filters = dict(filters)
+        if filters.get("older_than") is not None:
+            filters["older_than"] = datetime.fromisoformat(filters["older_than"])
+
+        return cls(**filters)
@@ -0,0 +1,237 @@
+import csv
+import io
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+from datetime import datetime
+
+from handlers.log_handler import create_logger
+from id_index import IdSet
+from puush_entry import PuushEntry
+
+log = create_logger(__name__)
+
+EXPORT_FIELDS = ["identifier", "date", "url", "filename", "views", "unknown"]
+
+# Columnar file layout: magic, then row groups of
+# [uint32 row count][uint32 compressed length][zlib compressed column block].
+COLUMNAR_MAGIC = b"PSHCOL1\n"
+ROW_GROUP_HEADER = struct.Struct("<II")
+
+
+class EntryExporter:
+    """
+    Base class for streaming PuushEntry exporters.
+
+    Entries are written append-only through a buffered file, each identifier at most once,
+    and the file is fsynced periodically, so that exports of any size use constant memory
+    and survive crashes up to the last sync.
+    """
+    def __init__(self, path: str, fsync_interval: float = 5, buffer_size: int = 1024 * 1024):
+        """
+        :param path:
+        :param fsync_interval:  Seconds between each flush + fsync.
+        :param buffer_size:     Write buffer size in bytes.
+        """
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.last_fsync = time.monotonic()
+        self.exported_ids = IdSet()
+        self.lock = threading.Lock()
+
+        new_file = not os.path.isfile(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'ab', buffering=buffer_size)
+
+        if new_file:
+            self.write_header()
+
+    def write_header(self):
+        pass
+
+    def write_entry(self, entry: PuushEntry):
+        raise NotImplementedError
+
+    def export(self, entries):
+        """
+        Exports entries that haven't been exported yet.
+
+        Can be registered as an entry listener in puush_api, to export entries as deletion runs.
+        :param entries:
+        :return:
+        """
+        with self.lock:
+            for entry in entries:
+                if entry.identifier in self.exported_ids:
+                    continue
+
+                self.write_entry(entry)
+                self.exported_ids.add(entry.identifier)
+
+            if time.monotonic() - self.last_fsync >= self.fsync_interval:
+                self._sync()
+
+    def _sync(self):
+        """
+        Must be called with the lock held.
+        :return:
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_fsync = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            self._sync()
+            self.file.close()
+
+        log.info("Exported {} entries to {}".format(len(self.exported_ids), self.path))
+
+
+def entry_to_dict(entry: PuushEntry):
+    return {"identifier": entry.identifier,
+            "date": entry.date.isoformat(sep=' ') if entry.date is not None else None,
+            "url": entry.url,
+            "filename": entry.filename,
+            "views": entry.views,
+            "unknown": entry.unknown}
+
+
+class JsonLinesExporter(EntryExporter):
+    def write_entry(self, entry: PuushEntry):
+        self.file.write(json.dumps(entry_to_dict(entry), ensure_ascii=False).encode('utf-8'))
+        self.file.write(b"\n")
+
+
+class CsvExporter(EntryExporter):
+    def __init__(self, *args, **kwargs):
+        self.text = io.StringIO()
+        self.writer = csv.writer(self.text)
+
+        super().__init__(*args, **kwargs)
+
+    def _write_row(self, row: list):
+        self.writer.writerow(row)
+        self.file.write(self.text.getvalue().encode('utf-8'))
+        self.text.seek(0)
+        self.text.truncate()
+
+    def write_header(self):
+        self._write_row(EXPORT_FIELDS)
+
+    def write_entry(self, entry: PuushEntry):
+        row = entry_to_dict(entry)
+        self._write_row([row[field] for field in EXPORT_FIELDS])
+
+
+class ColumnarExporter(EntryExporter):
+    """
+    Exports entries in row groups, storing each column contiguously and compressed.
+
+    Integer columns (identifier, date as UNIX timestamp, views) are packed as 64-bit arrays
+    and string columns as NUL separated UTF-8, which compresses far better than row formats.
+    """
+    def __init__(self, path: str, row_group_size: int = 10000, **kwargs):
+        """
+        :param path:
+        :param row_group_size:  Entries buffered in memory per row group.
+        :param kwargs:          See EntryExporter.
+        """
+        self.row_group_size = row_group_size
+        self.rows = []
+
+        super().__init__(path, **kwargs)
+
+    def write_header(self):
+        self.file.write(COLUMNAR_MAGIC)
+
+    def write_entry(self, entry: PuushEntry):
+        self.rows.append(entry)
+
+        if len(self.rows) >= self.row_group_size:
+            self.write_row_group()
+
+    def write_row_group(self):
+        if len(self.rows) == 0:
+            return
+
+        identifiers = array('q', (entry.identifier for entry in self.rows))
+        dates = array('q', (int(entry.date.timestamp()) if entry.date is not None else -1 for entry in self.rows))
+        views = array('q', (entry.views if entry.views is not None else -1 for entry in self.rows))
+        strings = [b"\0".join((getattr(entry, field) or "").encode('utf-8') for entry in self.rows)
+                   for field in ("url", "filename", "unknown")]
+
+        columns = [identifiers.tobytes(), dates.tobytes(), views.tobytes()] + strings
+        block = zlib.compress(b"".join(struct.pack("<I", len(column)) + column for column in columns))
+
+        self.file.write(ROW_GROUP_HEADER.pack(len(self.rows), len(block)))
+        self.file.write(block)
+        self.rows = []
+
+    def _sync(self):
+        self.write_row_group()
+        super()._sync()
+
+
+def read_columnar(path: str):
+    """
+    Reads back a columnar export.
+    :param path:
+    :return: Generator of PuushEntry.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+            raise ValueError("{} is not a columnar export!".format(path))
+
+        while True:
+            header = f.read(ROW_GROUP_HEADER.size)
+            if len(header) < ROW_GROUP_HEADER.size:
+                break
+
+            row_count, block_length = ROW_GROUP_HEADER.unpack(header)
+            block = zlib.decompress(f.read(block_length))
+
+            columns = []
+            offset = 0
+            while offset < len(block):
+                length, = struct.unpack_from("<I", block, offset)
+                columns.append(block[offset + 4:offset + 4 + length])
+                offset += 4 + length
+
+            identifiers, dates, views = (array('q', column) for column in columns[:3])
+            urls, filenames, unknowns = (column.decode('utf-8').split("\0") for column in columns[3:])
+
+            for i in range(row_count):
+                yield PuushEntry(identifiers[i],
+                                 datetime.fromtimestamp(dates[i]) if dates[i] != -1 else None,
+                                 urls[i] or None,
+                                 filenames[i] or None,
+                                 views[i] if views[i] != -1 else None,
+                                 unknowns[i])
+
+
+EXPORTERS = {"jsonl": JsonLinesExporter,
+             "csv": CsvExporter,
+             "columnar": ColumnarExporter}
+
+
+def create_exporter(path: str, export_format: str = None, **kwargs):
+    """
+    Creates an exporter, guessing the format from the file extension if not given.
+    :param path:
+    :param export_format:   One of EXPORTERS.
+    :param kwargs:          Passed on to the exporter.
+    :return:
+    """
+    if export_format is None:
+        extension = os.path.splitext(path)[1].lstrip(".").lower()
+        export_format = extension if extension in EXPORTERS else "jsonl"
+
+    if export_format not in EXPORTERS:
+        raise ValueError("Unknown export format {}, expected one of: {}".format(
+            export_format, ", ".join(EXPORTERS.keys())))
+
+    return EXPORTERS[export_format](path, **kwargs)
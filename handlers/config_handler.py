@@ -8,16 +8,43 @@ from settings import CONFIG_PATH, SAMPLE_CONFIG_PATH, LOG_DIR
 DEFAULT_CONFIG = {
     "log_level": 40,
     "log_to_file": True,
+    "log_format": "text",
+    "print_requests": False,
     "log_dir": str(LOG_DIR),
     "log_bind_port": 19994,
     "log_bind_host": "127.0.0.1",
     "api_key": None,
-    "api_rate_limit_delay_seconds": 5
+    "api_base_url": "https://puush.me/api",
+    "api_rate_limit_per_second": 1,
+    "api_rate_limit_burst": 5,
+    "adaptive_rate_limit": True,
+    "api_rate_limit_min_per_second": 0.1,
+    "api_rate_limit_max_per_second": 20,
+    "api_max_backoff_seconds": 60,
+    "api_max_retries": 8,
+    "api_latency_threshold_seconds": 5,
+    "deletion_workers": 4,
+    "prefetch_queue_size": 50,
+    "http_pool_size": 10,
+    "http_max_retries": 3,
+    "http_retry_backoff_factor": 0.5,
+    "http_timeout_seconds": 30,
+    "async_concurrency": 100,
+    "upload_hash_workers": None,
+    "upload_timeout_seconds": 600,
+    "thumbnail_cache_memory_bytes": 33554432,
+    "journal_enabled": True,
+    "journal_batch_size": 50,
+    "metrics_bind_host": "127.0.0.1",
+    "metrics_bind_port": None
 }
 
 # Let's make sure we copy default config by value, not reference. So that it remains unmodified.
 CONFIG = copy.deepcopy(DEFAULT_CONFIG)
 
+# Whether the custom config file has been read into CONFIG yet.
+CONFIG_LOADED = False
+
 
 def has_option(cfg: json, cfg_key: str):
     if cfg_key in cfg:
@@ -27,6 +54,8 @@ def has_option(cfg: json, cfg_key: str):
 
 
 def get_option(key, default=None):
+    load_config()
+
     if key in CONFIG:
         return CONFIG[key]
     else:
@@ -50,18 +79,34 @@ def update_sample_config(sample_config=SAMPLE_CONFIG_PATH):
 def set_custom_config_options(cfg: json):
     global CONFIG
 
+    # Read the config file first, so that it doesn't override these options when it is loaded on first use.
+    load_config()
+
     for key, value in cfg.items():
         CONFIG[key] = value
 
 
-def load_config(config_file=CONFIG_PATH):
-    global CONFIG
+def load_config(config_file=CONFIG_PATH, reload: bool = False):
+    """
+    Loads the custom config file into CONFIG, once.
+
+    Idempotent, so every module can call it (or get_option) without re-reading the file.
+    :param config_file:
+    :param reload:      Read the config file again, even if it was already loaded.
+    :return: CONFIG
+    """
+    global CONFIG, CONFIG_LOADED
+
+    if CONFIG_LOADED and not reload:
+        return CONFIG
+
+    CONFIG_LOADED = True
 
     # Create a sample config file.
     # update_sample_config()
 
     # If config file doesn't exist
-    if has_custom_config():
+    if has_custom_config(config_file):
         try:
             with open(config_file) as f:
                 # Override config options with those defined in the custom config file.
@@ -0,0 +1,399 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from entry_filter import EntryFilter
+from handlers.config_handler import get_option
+from handlers.log_handler import create_logger
+from puush_entry import PuushEntry
+from settings import DATABASE_PATH
+
+log = create_logger(__name__)
+
+# Open deletion journals, by database path.
+JOURNALS = {}
+JOURNAL_LOCK = threading.Lock()
+
+# Deletion status of a journaled entry.
+STATUS_SEEN = "seen"
+STATUS_DELETED = "deleted"
+STATUS_MISSING = "missing"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    date TEXT,
+    url TEXT,
+    filename TEXT,
+    views INTEGER,
+    unknown TEXT,
+    status TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_status ON entries (status);
+CREATE INDEX IF NOT EXISTS entries_status_date ON entries (status, date);
+CREATE INDEX IF NOT EXISTS entries_status_views ON entries (status, views);
+CREATE TABLE IF NOT EXISTS hashes (
+    id INTEGER PRIMARY KEY,
+    thumbnail_hash TEXT,
+    content_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS hashes_content_hash ON hashes (content_hash);
+CREATE TABLE IF NOT EXISTS snapshot (
+    id INTEGER PRIMARY KEY,
+    views INTEGER
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value INTEGER
+);
+"""
+
+# Hash columns of the hashes table, by kind.
+HASH_COLUMNS = {"thumbnail": "thumbnail_hash", "content": "content_hash"}
+
+# Same format as the API uses, so that dates compare correctly as text.
+DATE_SEPARATOR = ' '
+
+
+def row_to_entry(row):
+    """
+    :param row: (id, date, url, filename, views, unknown) row.
+    :return:
+    """
+    return PuushEntry(row[0], datetime.fromisoformat(row[1]) if row[1] is not None else None,
+                      row[2], row[3], row[4], row[5])
+
+
+class DeletionJournal:
+    """
+    Durable SQLite journal of every seen PuushEntry and its deletion status.
+
+    The database runs in WAL mode and writes are committed in batches, so journaling
+    doesn't add a disk sync to every request. A crash loses at most one uncommitted batch,
+    and entries in it are simply rediscovered from the API.
+    """
+    def __init__(self, database_path=DATABASE_PATH, batch_size: int = 50):
+        """
+        :param database_path:
+        :param batch_size:      Amount of writes between each commit.
+        """
+        self.batch_size = batch_size
+        self.uncommitted = 0
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(str(database_path), check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+
+        log.db_info("Opened deletion journal {}".format(database_path))
+
+    def _wrote(self, count: int = 1):
+        """
+        Registers writes and commits the batch once it is full.
+
+        Must be called with the lock held.
+        :param count:
+        :return:
+        """
+        self.uncommitted += count
+
+        if self.uncommitted >= self.batch_size:
+            self.connection.commit()
+            log.db_debug("Committed {} journal writes".format(self.uncommitted))
+            self.uncommitted = 0
+
+    def record_seen(self, entries: list):
+        """
+        Records entries listed by the API, without touching the status of already journaled ones.
+        :param entries:
+        :return:
+        """
+        now = time.time()
+        rows = [(entry.identifier, entry.date.isoformat(sep=DATE_SEPARATOR) if entry.date is not None else None,
+                 entry.url, entry.filename, entry.views, entry.unknown, STATUS_SEEN, now) for entry in entries]
+
+        with self.lock:
+            self.connection.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                                        "ON CONFLICT (id) DO UPDATE SET views = excluded.views", rows)
+            self._wrote(len(rows))
+
+    def set_status(self, identifier, status: str):
+        """
+        Sets the deletion status of an entry, journaling it if it hasn't been seen before.
+        :param identifier:
+        :param status:
+        :return:
+        """
+        with self.lock:
+            self.connection.execute("INSERT INTO entries (id, status, updated_at) VALUES (?, ?, ?) "
+                                    "ON CONFLICT (id) DO UPDATE SET status = excluded.status, "
+                                    "updated_at = excluded.updated_at", (int(identifier), status, time.time()))
+            self._wrote()
+
+    def mark_deleted(self, identifier):
+        self.set_status(identifier, STATUS_DELETED)
+
+    def mark_missing(self, identifier):
+        self.set_status(identifier, STATUS_MISSING)
+
+    def ids_with_status(self, *statuses):
+        """
+        :param statuses:
+        :return: List of identifiers having any of the given statuses.
+        """
+        with self.lock:
+            cursor = self.connection.execute(
+                "SELECT id FROM entries WHERE status IN ({})".format(",".join("?" * len(statuses))), statuses)
+
+            return [row[0] for row in cursor]
+
+    def record_hashes(self, kind: str, hashes: dict):
+        """
+        Indexes the thumbnail or content hashes of entries, so that they never have to be fetched again.
+        :param kind:    "thumbnail" or "content".
+        :param hashes:  dict of identifier: hash.
+        :return:
+        """
+        column = HASH_COLUMNS[kind]
+
+        with self.lock:
+            self.connection.executemany("INSERT INTO hashes (id, {0}) VALUES (?, ?) "
+                                        "ON CONFLICT (id) DO UPDATE SET {0} = excluded.{0}".format(column),
+                                        hashes.items())
+            self._wrote(len(hashes))
+
+    def hashes(self, kind: str, identifiers):
+        """
+        :param kind:        "thumbnail" or "content".
+        :param identifiers:
+        :return: dict of identifier: hash, for the given entries whose hash is indexed.
+        """
+        column = HASH_COLUMNS[kind]
+        hashes = {}
+
+        with self.lock:
+            for identifier in identifiers:
+                row = self.connection.execute("SELECT {} FROM hashes WHERE id = ?".format(column),
+                                              (int(identifier),)).fetchone()
+
+                if row is not None and row[0] is not None:
+                    hashes[identifier] = row[0]
+
+        return hashes
+
+    def high_water_mark(self):
+        """
+        :return: Highest ID seen by the last sync, or None if there hasn't been one.
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM sync_state WHERE key = 'high_water_mark'").fetchone()
+
+            return row[0] if row is not None else None
+
+    def snapshot_views(self, min_id: int = None):
+        """
+        :param min_id:
+        :return: dict of identifier: view count as of the last sync, for snapshotted entries from min_id up.
+        """
+        with self.lock:
+            return dict(self.connection.execute("SELECT id, views FROM snapshot WHERE id >= ?",
+                                                (min_id if min_id is not None else 0,)))
+
+    def record_snapshot(self, entries: list, removed: list, high_water_mark: int):
+        """
+        Replaces the snapshot of the listed entries, drops entries that disappeared from it (marking them missing
+        unless they're known to be deleted) and advances the high-water mark, in a single transaction.
+        :param entries:
+        :param removed:         Identifiers of snapshotted entries that are gone.
+        :param high_water_mark:
+        :return:
+        """
+        with self.lock:
+            self.connection.executemany("INSERT INTO snapshot VALUES (?, ?) "
+                                        "ON CONFLICT (id) DO UPDATE SET views = excluded.views",
+                                        [(entry.identifier, entry.views) for entry in entries])
+            self.connection.executemany("DELETE FROM snapshot WHERE id = ?", [(identifier,) for identifier in removed])
+            self.connection.executemany("UPDATE entries SET status = ?, updated_at = ? WHERE id = ? AND status = ?",
+                                        [(STATUS_MISSING, time.time(), identifier, STATUS_SEEN)
+                                         for identifier in removed])
+
+            if high_water_mark is not None:
+                self.connection.execute("INSERT INTO sync_state VALUES ('high_water_mark', ?) "
+                                        "ON CONFLICT (key) DO UPDATE SET value = MAX(value, excluded.value)",
+                                        (high_water_mark,))
+
+            self.connection.commit()
+            self.uncommitted = 0
+
+    def status_counts(self):
+        """
+        :return: dict of status: amount of journaled entries.
+        """
+        with self.lock:
+            return dict(self.connection.execute("SELECT status, COUNT(*) FROM entries GROUP BY status"))
+
+    def lowest_pending_id(self):
+        """
+        :return: Lowest ID of the entries that have been seen but not yet deleted, or None.
+        """
+        with self.lock:
+            return self.connection.execute("SELECT MIN(id) FROM entries WHERE status = ?", (STATUS_SEEN,)).fetchone()[0]
+
+    def deleted_ids(self):
+        """
+        :return: IDs of entries known to be gone, which must never be deleted again.
+        """
+        return self.ids_with_status(STATUS_DELETED, STATUS_MISSING)
+
+    def pending_entries(self):
+        """
+        :return: Entries that have been seen, but not yet deleted, ordered by ID.
+        """
+        with self.lock:
+            cursor = self.connection.execute("SELECT id, date, url, filename, views, unknown FROM entries "
+                                             "WHERE status = ? ORDER BY id", (STATUS_SEEN,))
+
+            return [row_to_entry(row) for row in cursor]
+
+    def query_entries(self, entry_filter: EntryFilter, min_id: int = None, max_id: int = None):
+        """
+        Selects the pending entries matching the filter's metadata predicates in a single indexed query,
+        instead of checking entries one by one. Size predicates aren't journaled, so they're left to the caller.
+
+        The filename pattern is matched against the rows the date and views indexes narrowed down to,
+        by EntryFilter itself, so that it means the same as when the filter is applied to listed entries.
+        :param entry_filter:
+        :param min_id:
+        :param max_id:
+        :return: Matching entries, ordered by ID.
+        """
+        conditions = ["status = ?"]
+        params = [STATUS_SEEN]
+
+        if entry_filter.older_than is not None:
+            conditions.append("date < ?")
+            params.append(entry_filter.older_than.isoformat(sep=DATE_SEPARATOR))
+
+        if entry_filter.max_views is not None:
+            conditions.append("views <= ?")
+            params.append(entry_filter.max_views)
+
+        if min_id is not None:
+            conditions.append("id >= ?")
+            params.append(min_id)
+
+        if max_id is not None:
+            conditions.append("id <= ?")
+            params.append(max_id)
+
+        with self.lock:
+            cursor = self.connection.execute("SELECT id, date, url, filename, views, unknown FROM entries "
+                                             "WHERE {} ORDER BY id".format(" AND ".join(conditions)), params)
+
+            return [row_to_entry(row) for row in cursor if entry_filter.matches_filename(row[3])]
+
+    def flush(self):
+        with self.lock:
+            self.connection.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+def account_hash(api_key: str = None):
+    """
+    Identifies an account without storing its API key.
+    :param api_key: Defaults to the one in config.
+    :return: Hex digest, or None if there is no API key.
+    """
+    if api_key is None:
+        api_key = get_option("api_key", default=None)
+
+    if api_key is None:
+        return None
+
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+def check_account(saved: dict, path):
+    """
+    Refuses to resume progress (e.g. a sweep state or plan) that was saved for another account.
+    Progress saved before accounts were recorded is assumed to be the configured account's.
+    :param saved:   dict with the "account" hash it was saved for.
+    :param path:    Where it was saved, for the error message.
+    :return:
+    """
+    if saved.get("account") is not None and saved["account"] != account_hash():
+        raise Exception("{} was saved for another account, use that account's API key to resume it, "
+                        "or delete it!".format(path))
+
+
+def journal_path(api_key: str = None):
+    """
+    Every account is journaled to a database of its own, named after a hash of its API key,
+    so that entries of one account are never resumed, planned or deduplicated with another's.
+    :param api_key: Defaults to the one in config.
+    :return: Path of the account's database, or the shared one if there is no API key.
+    """
+    account = account_hash(api_key)
+
+    if account is None:
+        return DATABASE_PATH
+
+    return DATABASE_PATH.with_name("{}-{}{}".format(DATABASE_PATH.stem, account, DATABASE_PATH.suffix))
+
+
+def adopt_legacy_journal(database_path):
+    """
+    Journals used to be shared by all accounts, hand one left behind by an older version to the configured account,
+    which is the only one that wrote to it.
+    :param database_path:
+    :return:
+    """
+    if database_path == DATABASE_PATH or os.path.isfile(database_path) or not os.path.isfile(DATABASE_PATH):
+        return
+
+    # WAL and shared memory files hold not yet checkpointed writes, so they have to move along.
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.isfile("{}{}".format(DATABASE_PATH, suffix)):
+            os.replace("{}{}".format(DATABASE_PATH, suffix), "{}{}".format(database_path, suffix))
+
+    log.db_info("Moved deletion journal {} to {}".format(DATABASE_PATH, database_path))
+
+
+def get_journal(api_key: str = None):
+    """
+    Returns *the* (singular) deletion journal of an account, opening it on first use.
+    :param api_key: Defaults to the one in config.
+    :return: DeletionJournal, or None if journaling is disabled in config.
+    """
+    if get_option("journal_enabled", default=True) is not True:
+        return None
+
+    database_path = journal_path(api_key)
+
+    with JOURNAL_LOCK:
+        if database_path not in JOURNALS:
+            if api_key is None:
+                adopt_legacy_journal(database_path)
+
+            JOURNALS[database_path] = DeletionJournal(database_path,
+                                                      batch_size=get_option("journal_batch_size", default=50))
+
+        return JOURNALS[database_path]
+
+
+def close_journal():
+    with JOURNAL_LOCK:
+        for journal in JOURNALS.values():
+            journal.close()
+
+        JOURNALS.clear()
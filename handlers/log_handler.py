@@ -1,18 +1,47 @@
 # -*- coding: utf-8 -*-
+import atexit
 import json
 import logging
 import os
-from logging.handlers import SocketHandler
-from handlers.config_handler import load_config, get_option
-
-config = load_config()
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener, SocketHandler
+from handlers.config_handler import get_option
 
 LOG_FILE_HANDLER = None
-LOG_TO_FILE = get_option("log_to_file", default=True)
+LOG_QUEUE_HANDLER = None
+LOG_QUEUE_LISTENER = None
+LOG_SOCKET_HANDLER = None
+
+# Set up by init_logging(), so that importing a module doesn't touch config, the log dir or start threads.
+LOG_TO_FILE = None
+FORMATTER = None
+LOG_FILE = None
+log_level = None
+
+LOGGING_INITIALIZED = False
+LOGGING_LOCK = threading.RLock()
 
+# Loggers created before init_logging(), which get their handler attached once it runs.
+PENDING_LOGGERS = []
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    Formats records as single line JSON objects, for machine-readable logs.
+    """
+    def format(self, record):
+        entry = {"time": self.formatTime(record),
+                 "name": record.name,
+                 "level": record.levelname,
+                 "thread": record.threadName,
+                 "message": record.getMessage()}
+
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, ensure_ascii=False)
 
-# create formatter and add it to the handlers
-FORMATTER = logging.Formatter(u'%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
 DEFAULT_LOG_LEVELS = [0, 10, 20, 30, 40, 50]
 
@@ -34,12 +63,6 @@ LOG_LEVELS = {'UNSET': 0,
               'ERROR': 40,
               'CRITICAL': 50}
 
-# Determine log level name by int:
-# Separate the dictionary's values in a list, find the position of the given value, and gets the key at that position.
-# Additionally order is guaranteed not to change through iterations, as long as the dictionary is not modified.
-log_level = get_option("log_level", default=40)
-log_level_name = list(LOG_LEVELS.keys())[list(LOG_LEVELS.values()).index(int(log_level))]
-LOG_FILE = "{}.log".format(log_level_name)
 
 
 def db_info(self, message, *args, **kwargs):
@@ -175,16 +198,29 @@ def spam(self, message, *args, **kwargs):
         self._log(LOG_LEVELS['SPAM'], message, args, **kwargs)
 
 
-def create_logger_socket(facility):
+def create_formatter():
+    # create formatter and add it to the handlers
+    if get_option("log_format", default="text") == "json":
+        return JsonLinesFormatter()
+
+    return logging.Formatter(u'%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+
+def create_socket_handler():
     """
-    Create and return a a logging instance that logs to socket.
-    :param facility:
+    Creates *the* (singular) socket handler for logging to socket (log to file is False).
     :return:
     """
-    return log_socket_instance.getChild(facility)
+    global LOG_SOCKET_HANDLER
+
+    if LOG_SOCKET_HANDLER is None:
+        port = get_option("log_bind_port", default=19994)
+        host = get_option("log_bind_host", default="127.0.0.1")
+
+        LOG_SOCKET_HANDLER = SocketHandler(host, port)  # default listening address
 
 
-def create_file_handler(log_file=LOG_FILE, formatter=FORMATTER):
+def create_file_handler(log_file=None, formatter=None):
     """
     Creates *the* (singular) file handler for logging to text file.
 
@@ -198,11 +234,12 @@ def create_file_handler(log_file=LOG_FILE, formatter=FORMATTER):
 
     # Only create one instance of the file handler
     if LOG_TO_FILE is True and LOG_FILE_HANDLER is None:
-        logfile_path = os.path.join(config["log_dir"], log_file)
+        log_dir = get_option("log_dir")
+        logfile_path = os.path.join(log_dir, log_file or LOG_FILE)
 
         # Make sure logs dir exists, if not create it.
-        if not os.path.isdir(config["log_dir"]):
-            os.makedirs(config["log_dir"])
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
 
         # Make sure logfile exists, if not create it.
         if not os.path.isfile(logfile_path):
@@ -210,70 +247,116 @@ def create_file_handler(log_file=LOG_FILE, formatter=FORMATTER):
 
         LOG_FILE_HANDLER = logging.FileHandler(logfile_path, encoding="UTF-8")
         LOG_FILE_HANDLER.setLevel(logging.DEBUG)
-        LOG_FILE_HANDLER.setFormatter(formatter)
+        LOG_FILE_HANDLER.setFormatter(formatter or FORMATTER)
 
 
-def create_logger_file(facility, formatter=FORMATTER):
+def create_queue_handler(formatter=None):
     """
-    Create and return a a logging instance that logs to file.
-    :param facility:
+    Creates *the* (singular) queue handler that all file loggers log through.
+
+    Log records are only put on a queue by the logging thread, while a background
+    QueueListener does the actual (file and console) I/O.
     :param formatter:
     :return:
     """
-    global LOG_FILE_HANDLER
+    global LOG_QUEUE_HANDLER, LOG_QUEUE_LISTENER
 
-    log_file_instance = logging.getLogger(facility)
+    # Only create one instance of the queue handler and listener
+    if LOG_QUEUE_HANDLER is None:
+        # create console handler with a higher log level
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.ERROR)
+        # patch the default logging formatter to use unicode format string
+        logging._defaultFormatter = logging.Formatter(u"%(message)s")
+        ch.setFormatter(formatter or FORMATTER)
 
-    log_file_instance.setLevel(logging.DEBUG)
-    # create file handler which logs even debug messages
-    if not os.path.exists(config["log_dir"]):
-        os.makedirs(config["log_dir"])
+        handlers = [ch] if LOG_FILE_HANDLER is None else [LOG_FILE_HANDLER, ch]
 
-    # create console handler with a higher log level
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.ERROR)
-    # patch the default logging formatter to use unicode format string
-    logging._defaultFormatter = logging.Formatter(u"%(message)s")
-    ch.setFormatter(formatter)
+        log_queue = queue.SimpleQueue()
+        LOG_QUEUE_HANDLER = QueueHandler(log_queue)
+        LOG_QUEUE_LISTENER = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        LOG_QUEUE_LISTENER.start()
 
-    # add the handlers to the logger
-    log_file_instance.addHandler(LOG_FILE_HANDLER)
-    log_file_instance.addHandler(ch)
+        # Make sure queued records are written before the process exits.
+        atexit.register(LOG_QUEUE_LISTENER.stop)
 
-    return log_file_instance
+
+def attach_handler(logger_instance):
+    """
+    Attaches the configured handler (queue or socket) to a logger, once.
+
+    Must be called with the logging lock held, after init_logging() has set up the handlers.
+    :param logger_instance:
+    :return:
+    """
+    handler = LOG_QUEUE_HANDLER if LOG_TO_FILE is True else LOG_SOCKET_HANDLER
+
+    # Records below the configured level are dropped before any formatting happens.
+    logger_instance.setLevel(log_level)
+
+    if handler not in logger_instance.handlers:
+        logger_instance.addHandler(handler)
+
+
+def init_logging():
+    """
+    Sets up logging as configured: file (and errors to console) through the queue handler, or socket.
+
+    Idempotent, so every entry point can call it, and cheap to skip for commands that don't log.
+    Until it runs, records are handled by the logging module's defaults (warnings and up to stderr).
+    :return:
+    """
+    global LOG_TO_FILE, FORMATTER, LOG_FILE, log_level, LOGGING_INITIALIZED
+
+    with LOGGING_LOCK:
+        if LOGGING_INITIALIZED:
+            return
+
+        LOG_TO_FILE = get_option("log_to_file", default=True)
+        FORMATTER = create_formatter()
+
+        # Determine log level name by int:
+        # Separate the dictionary's values in a list, find the position of the given value,
+        # and gets the key at that position.
+        # Additionally order is guaranteed not to change through iterations, as long as the dictionary is not modified.
+        log_level = get_option("log_level", default=40)
+        log_level_name = list(LOG_LEVELS.keys())[list(LOG_LEVELS.values()).index(int(log_level))]
+        LOG_FILE = "{}.log".format(log_level_name)
+
+        if LOG_TO_FILE is False:
+            create_socket_handler()
+        else:
+            create_file_handler()
+            create_queue_handler()
+
+        LOGGING_INITIALIZED = True
+
+        for logger_instance in PENDING_LOGGERS:
+            attach_handler(logger_instance)
+        PENDING_LOGGERS.clear()
 
 
 def create_logger(facility):
     """
-    Creates a logger function based on the logging library
+    Creates a logger function based on the logging library.
+
+    Creating a logger is cheap, its handler is attached by init_logging() (or right away, if that already ran).
     :param facility:     Name of what's calling logger.
     :return:
     """
-    create_file_handler()
-
-    # create logger
-    if LOG_TO_FILE is False:
-        logger_instance = create_logger_socket(facility)
-    else:
-        logger_instance = create_logger_file(facility)
+    logger_instance = logging.getLogger(facility)
 
     # Attach a handle to the log levels dict.
     setattr(logger_instance, "my_log_levels", LOG_LEVELS)
 
-    return logger_instance
-
+    with LOGGING_LOCK:
+        if LOGGING_INITIALIZED:
+            attach_handler(logger_instance)
+        elif logger_instance not in PENDING_LOGGERS:
+            PENDING_LOGGERS.append(logger_instance)
 
-# Logging to socket (log to file is False).
-if LOG_TO_FILE is False:
-    log_socket_instance = logging.getLogger('r')
-    log_level = get_option("log_level", default=40)
-    port = get_option("log_bind_port", default=19994)
-    host = get_option("log_bind_host", default="127.0.0.1")
-
-    log_socket_instance.setLevel(log_level)  # to send all records to socket logger
+    return logger_instance
 
-    socket_handler = SocketHandler(host, port)  # default listening address
-    log_socket_instance.addHandler(socket_handler)
 
 # Add custom logging levels (descending order)
 for level, value in LOG_LEVELS.items():
@@ -0,0 +1,258 @@
+import random
+import threading
+import time
+
+from handlers.config_handler import get_option
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter.
+
+    Tokens are refilled continuously at `rate` tokens per second, and at most `burst` tokens
+    can be saved up, which allows short bursts of requests without exceeding the average rate.
+    """
+    def __init__(self, rate: float, burst: int = 1):
+        """
+        :param rate:    Tokens refilled per second.
+        :param burst:   Maximum amount of tokens the bucket can hold.
+        """
+        if rate <= 0:
+            raise ValueError("TokenBucket rate must be positive, got {}!".format(rate))
+        if burst < 1:
+            raise ValueError("TokenBucket burst must be at least 1, got {}!".format(burst))
+
+        self.rate = float(rate)
+        self.burst = int(burst)
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        """
+        Refill tokens based on the time passed since last refill.
+
+        Must be called with the lock held.
+        :return:
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def set_rate(self, rate: float):
+        """
+        Changes the refill rate, keeping the tokens refilled at the old rate so far.
+        :param rate:
+        :return:
+        """
+        with self.lock:
+            self._refill()
+            self.rate = float(rate)
+
+    def on_success(self, latency: float):
+        """
+        Feedback hook for a successful request, a plain token bucket ignores it.
+        :param latency: Request duration in seconds.
+        :return:
+        """
+        pass
+
+    def on_failure(self):
+        """
+        Feedback hook for a failed request, a plain token bucket ignores it.
+        :return:
+        """
+        pass
+
+    def wait_time(self, tokens: int = 1):
+        """
+        :param tokens:
+        :return: Seconds until the given amount of tokens is expected to be available.
+        """
+        with self.lock:
+            self._refill()
+
+            return max(0.0, (tokens - self.tokens) / self.rate)
+
+    async def acquire_async(self, tokens: int = 1):
+        """
+        Take tokens from the bucket, waiting without blocking the event loop until enough tokens are available.
+        :param tokens:
+        :return: Seconds spent waiting.
+        """
+        # Only imported by the async client's callers, so threaded runs don't pay for importing asyncio.
+        import asyncio
+
+        waited = 0.0
+
+        while not self.try_acquire(tokens):
+            # Tokens may be taken by others in the meantime, so don't wait for less than a millisecond.
+            wait = max(0.001, self.wait_time(tokens))
+            await asyncio.sleep(wait)
+            waited += wait
+
+        return waited
+
+    def try_acquire(self, tokens: int = 1):
+        """
+        Attempt to take tokens from the bucket without blocking.
+        :param tokens:
+        :return: True if tokens were taken, otherwise False.
+        """
+        with self.lock:
+            self._refill()
+
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+
+            return False
+
+    def acquire(self, tokens: int = 1):
+        """
+        Take tokens from the bucket, blocking until enough tokens are available.
+        :param tokens:
+        :return: Seconds spent waiting.
+        """
+        if tokens > self.burst:
+            raise ValueError("Cannot acquire {} tokens from a bucket with burst {}!".format(tokens, self.burst))
+
+        waited = 0.0
+
+        while True:
+            with self.lock:
+                self._refill()
+
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return waited
+
+                # Time until enough tokens have been refilled.
+                wait = (tokens - self.tokens) / self.rate
+
+            time.sleep(wait)
+            waited += wait
+
+
+class AdaptiveRateLimiter(TokenBucket):
+    """
+    Token bucket whose rate is adapted to the server's health (AIMD).
+
+    Each success increases the rate, up to max_rate, by a constant plus a fraction of the current rate,
+    so that recovery from a low rate doesn't take ages. A failure (or a response slower than latency_threshold)
+    decreases it multiplicatively, down to min_rate, but at most once per decrease_interval: concurrent requests
+    failing together are one congestion signal, not one per worker. Failures additionally pause all
+    requests for an exponentially growing, fully jittered backoff period.
+    """
+    def __init__(self, rate: float, burst: int = 1, min_rate: float = 0.1, max_rate: float = 20,
+                 increase: float = 0.05, increase_ratio: float = 0.01, decrease_factor: float = 0.5,
+                 decrease_interval: float = 1, base_backoff: float = 1, max_backoff: float = 60,
+                 latency_threshold: float = None):
+        """
+        :param rate:                Initial tokens refilled per second.
+        :param burst:               Maximum amount of tokens the bucket can hold.
+        :param min_rate:            Lowest rate to back off to.
+        :param max_rate:            Highest rate to speed up to.
+        :param increase:            Rate added per successful request.
+        :param increase_ratio:      Fraction of the current rate added per successful request.
+        :param decrease_factor:     Rate multiplier per decrease.
+        :param decrease_interval:   Minimum amount of seconds between decreases.
+        :param base_backoff:        Backoff in seconds after the first consecutive failure.
+        :param max_backoff:         Upper limit of the backoff in seconds.
+        :param latency_threshold:   Request duration in seconds that counts as a sign of congestion.
+        """
+        super().__init__(min(max(rate, min_rate), max_rate), burst)
+
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.increase_ratio = increase_ratio
+        self.decrease_factor = decrease_factor
+        self.decrease_interval = decrease_interval
+        self.last_decrease = None
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.latency_threshold = latency_threshold
+        self.consecutive_failures = 0
+        self.backoff_until = 0.0
+
+    def _decrease(self):
+        """
+        Must be called with the lock held.
+        :return:
+        """
+        now = time.monotonic()
+
+        if self.last_decrease is not None and now - self.last_decrease < self.decrease_interval:
+            return
+
+        self._refill()
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        self.last_decrease = now
+
+    def on_success(self, latency: float):
+        with self.lock:
+            self.consecutive_failures = 0
+
+            if self.latency_threshold is not None and latency > self.latency_threshold:
+                self._decrease()
+            else:
+                self._refill()
+                self.rate = min(self.max_rate, self.rate + self.increase + self.rate * self.increase_ratio)
+
+    def on_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            self._decrease()
+
+            # Exponential backoff with full jitter, so that workers don't retry in lockstep.
+            backoff = random.uniform(0, min(self.max_backoff,
+                                            self.base_backoff * 2 ** (self.consecutive_failures - 1)))
+            self.backoff_until = max(self.backoff_until, time.monotonic() + backoff)
+
+            return backoff
+
+    def wait_time(self, tokens: int = 1):
+        with self.lock:
+            backoff = max(0.0, self.backoff_until - time.monotonic())
+
+        return backoff + super().wait_time(tokens)
+
+    def try_acquire(self, tokens: int = 1):
+        with self.lock:
+            if self.backoff_until > time.monotonic():
+                return False
+
+        return super().try_acquire(tokens)
+
+    def acquire(self, tokens: int = 1):
+        waited = 0.0
+
+        # Sit out any backoff period before competing for tokens.
+        while True:
+            with self.lock:
+                wait = self.backoff_until - time.monotonic()
+
+            if wait <= 0:
+                break
+
+            time.sleep(wait)
+            waited += wait
+
+        return waited + super().acquire(tokens)
+
+
+def create_rate_limiter():
+    """
+    Creates a rate limiter as configured, adaptive unless disabled.
+    :return:
+    """
+    if get_option("adaptive_rate_limit", default=True) is True:
+        return AdaptiveRateLimiter(get_option("api_rate_limit_per_second", default=1),
+                                   get_option("api_rate_limit_burst", default=5),
+                                   min_rate=get_option("api_rate_limit_min_per_second", default=0.1),
+                                   max_rate=get_option("api_rate_limit_max_per_second", default=20),
+                                   max_backoff=get_option("api_max_backoff_seconds", default=60),
+                                   latency_threshold=get_option("api_latency_threshold_seconds", default=None))
+
+    return TokenBucket(get_option("api_rate_limit_per_second", default=1), get_option("api_rate_limit_burst", default=5))
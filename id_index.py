@@ -0,0 +1,167 @@
+import threading
+
+# Each page is a bitmap covering 2**PAGE_BITS sequential IDs (512 bytes per page).
+PAGE_BITS = 12
+PAGE_SIZE = 1 << PAGE_BITS
+PAGE_MASK = PAGE_SIZE - 1
+
+
+class IdSet:
+    """
+    Compact set of (sequential) integer IDs.
+
+    IDs are stored as bits in fixed-size bitmap pages, keyed by the ID's high bits,
+    so membership tests are O(1) and memory use is one bit per ID in each touched page,
+    instead of a full Python int object per ID. Iteration is ordered by ID.
+
+    String IDs are accepted as well, and converted to int.
+    """
+    def __init__(self, identifiers=()):
+        self.pages = {}
+        self.count = 0
+        self.lock = threading.Lock()
+
+        self.update(identifiers)
+
+    def add(self, identifier):
+        identifier = int(identifier)
+        page_key = identifier >> PAGE_BITS
+        offset = identifier & PAGE_MASK
+        mask = 1 << (offset & 7)
+
+        with self.lock:
+            page = self.pages.get(page_key)
+            if page is None:
+                page = self.pages[page_key] = bytearray(PAGE_SIZE >> 3)
+
+            if not page[offset >> 3] & mask:
+                page[offset >> 3] |= mask
+                self.count += 1
+
+    def update(self, identifiers):
+        for identifier in identifiers:
+            self.add(identifier)
+
+    def clear(self):
+        with self.lock:
+            self.pages = {}
+            self.count = 0
+
+    def discard(self, identifier):
+        identifier = int(identifier)
+        offset = identifier & PAGE_MASK
+        mask = 1 << (offset & 7)
+
+        with self.lock:
+            page = self.pages.get(identifier >> PAGE_BITS)
+
+            if page is not None and page[offset >> 3] & mask:
+                page[offset >> 3] &= ~mask
+                self.count -= 1
+
+    def __contains__(self, identifier):
+        try:
+            identifier = int(identifier)
+        except (TypeError, ValueError):
+            return False
+
+        page = self.pages.get(identifier >> PAGE_BITS)
+        if page is None:
+            return False
+
+        offset = identifier & PAGE_MASK
+
+        return bool(page[offset >> 3] & (1 << (offset & 7)))
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for page_key in sorted(self.pages.keys()):
+            page = self.pages[page_key]
+            base = page_key << PAGE_BITS
+
+            for byte_index, byte in enumerate(page):
+                if byte == 0:
+                    continue
+
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        yield base + (byte_index << 3) + bit
+
+    def __repr__(self):
+        return "<{}: {} IDs in {} pages>".format(self.__class__.__name__, self.count, len(self.pages))
+
+
+class HistoryStore:
+    """
+    Indexed store of PuushEntry objects, keyed by (integer) identifier.
+
+    Replaces scanning plain lists of entries: lookups, inserts and removals are O(1),
+    and iteration is ordered by ID (newest first, like the history API).
+    """
+    def __init__(self, entries=()):
+        self.entries = {}
+
+        self.update(entries)
+
+    def add(self, entry):
+        """
+        Adds an entry, unless an entry with the same identifier is already stored.
+        :param entry:
+        :return: True if the entry was added.
+        """
+        key = int(entry.identifier)
+
+        if key in self.entries:
+            return False
+
+        self.entries[key] = entry
+        return True
+
+    def update(self, entries, id_blacklist=None):
+        """
+        Adds entries that aren't already stored or blacklisted.
+        :param entries:
+        :param id_blacklist: Container of identifiers to never add, e.g. an IdSet of deleted IDs.
+        :return: List of entries that were added.
+        """
+        added = []
+
+        for entry in entries:
+            if id_blacklist is not None and entry.identifier in id_blacklist:
+                continue
+
+            if self.add(entry):
+                added.append(entry)
+
+        return added
+
+    def discard(self, identifier):
+        return self.entries.pop(int(identifier), None)
+
+    def discard_all(self, id_blacklist):
+        """
+        Removes every stored entry whose identifier is in the blacklist.
+        :param id_blacklist:
+        :return: List of removed entries.
+        """
+        removed = [entry for key, entry in self.entries.items() if key in id_blacklist]
+
+        for entry in removed:
+            del self.entries[int(entry.identifier)]
+
+        return removed
+
+    def get(self, identifier, default=None):
+        return self.entries.get(int(identifier), default)
+
+    def __contains__(self, identifier):
+        return int(identifier) in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        for key in sorted(self.entries.keys(), reverse=True):
+            yield self.entries[key]
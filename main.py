@@ -1,216 +1,389 @@
-import time
-
-import requests
-
-from handlers.config_handler import load_config
-from handlers.log_handler import create_logger
-from puush_entry import PuushEntry
-from utils import logprint_request, logprint_response, logprint, logprint_error
+import argparse
+import logging
+import os
+from datetime import datetime
+from functools import partial
+
+from api_client import get_api_client
+from dedup import deduplicate
+from deletion_engine import DeletionEngine, PipelinedDeleter
+from downloader import Downloader
+from entry_filter import EntryFilter
+from exporter import EXPORTERS, create_exporter
+from handlers.config_handler import get_option
+from handlers.db_handler import close_journal, get_journal, journal_path
+from handlers.log_handler import LOG_LEVELS, create_logger, init_logging
+from handlers.rate_limit_handler import create_rate_limiter
+from id_index import HistoryStore
+from metrics import ProgressReporter, start_metrics_server
+from planner import create_plan, load_plan, print_plan, run_plan, save_plan
+from puush_api import API_STATUS_CODES, DELETED_ENTRIES_IDS, ENTRY_LISTENERS, SKIPPED_ENTRIES_IDS, \
+    api_call_summary, delete_puush_entry, get_history, is_transient_error
+from settings import DATABASE_PATH, UPLOAD_MANIFEST_PATH, VERSION
+from sweep import load_sweep_state, sweep, sweep_delete_entry
+from sync import print_sync, sync_history
+from thumbnail_cache import close_thumbnail_cache, prefetch_thumbnails
+from tracing import Profiler, start_tracing, stop_tracing
+from utils import logprint, logprint_error
 
 log = create_logger(__name__)
 
-API = "https://puush.me/api"
-AUTH_API = "{}/auth".format(API)
-HISTORY_API = "{}/hist".format(API)
-DELETION_API = "{}/del".format(API)
-THUMBNAIL_API = "{}/thumb".format(API)
-UPLOAD_API = "{}/up".format(API)
-
-API_STATUS_CODES = {
-    "0": "Success",
-    "-1": "General failure",
-    "-2": "Failure: A requested property was not found",
-    "-3": "Failure: Hash mismatch"
-}
-
-DELETED_ENTRIES_IDS = []
-
-config = load_config()
 
-
-def make_post_request(api_endpoint: str, data: dict):
+def resume_from_journal(engine: DeletionEngine, delete_func=sweep_delete_entry):
     """
-    Makes a HTTP POST request to an API endpoint, with an optional data payload.
-    :param api_endpoint:
-    :param data:
-    :return:
+    Restores deletion state from the journal of a previous run, and deletes
+    entries it had already seen without having to rediscover them through the API.
+    :param engine:
+    :param delete_func: Must tolerate entries that no longer exist, like sweep_delete_entry.
+    :return: Amount of deleted entries.
     """
-    response = requests.post(api_endpoint, data=data)
-    logprint_request(api_endpoint)
+    journal = get_journal()
 
-    logprint_response(response)
-    log.debug("Response dict:\n{}".format(response.__dict__))
+    if journal is None:
+        return 0
 
-    # Split response text into list of strings.
-    response_lines = response.text.split('\n')
-    log.info(response_lines)
+    DELETED_ENTRIES_IDS.update(journal.deleted_ids())
+    pending_entries = journal.pending_entries()
 
-    # Pop the first entry from the lines as it is a status code, and save it in its own variable.
-    status_code = response_lines.pop(0)
+    if len(DELETED_ENTRIES_IDS) > 0 or len(pending_entries) > 0:
+        logprint("Resuming from journal: {} entries already deleted, {} pending.".format(
+            len(DELETED_ENTRIES_IDS), len(pending_entries)))
 
-    if status_code != "0":
-        error_info = "Got non-zero return code {}".format(status_code)
+    # A previous run may have deleted some of these without getting to journal it, so tolerate missing IDs.
+    results = engine.delete_entries(pending_entries, delete_func=delete_func)
 
-        # If status code is known, append its meaning.
-        if status_code in API_STATUS_CODES:
-            error_info += ": {}".format(API_STATUS_CODES[status_code])
+    return sum(1 for entry, updated_history in results if updated_history is not None)
 
-        raise Exception("{}, aborting!".format(error_info))
 
-    # Remove empty entries
-    for i in range(len(response_lines)):
-        if response_lines[i] == "":
-            response_lines.pop(i)
+def is_excluded(entry):
+    return entry.identifier in DELETED_ENTRIES_IDS or entry.identifier in SKIPPED_ENTRIES_IDS
 
-    return response_lines
 
-
-def response_texts_to_entries(texts: list):
+def delete_history(engine: DeletionEngine, max_deletions: int = None):
     """
-    Takes a list of strings and creates a list of PuushEntry objects from it.
-    :param texts:
-    :return:
+    Deletes entries listed by the history API until the history is empty.
+
+    Every deletion responds with an updated history, which is merged into a live working set,
+    so the history API itself is only called when the working set runs dry.
+    :param engine:
+    :param max_deletions:   Stop after (roughly) this many deletions.
+    :return: Amount of deleted entries.
     """
-    entries = []
+    deleted = 0
+    working_set = HistoryStore()
 
-    # Remove empty text entries.
-    for i in range(len(texts)):
-        if texts[i] == "":
-            texts.pop(i)
+    while max_deletions is None or deleted < max_deletions:
+        if len(working_set) == 0:
+            # Get (hopefully) updated list of items from API.
+            history_entries = engine.call(get_history)
 
-    for text in texts:
-        # Split string into a list.
-        properties = text.split(',')
-        identifier = properties[0]
-        date = properties[1]
-        url = properties[2]
-        filename = properties[3]
-        views = properties[4]
-        unknown = properties[5]
+            if log.isEnabledFor(logging.INFO):
+                log.info([str(x) for x in history_entries])
+            working_set.update(entry for entry in history_entries if not is_excluded(entry))
 
-        if identifier in DELETED_ENTRIES_IDS:
-            log.warning("SKIPPING already deleted entry {} from unsanitary API response! "
-                        "The API is untrustworthy, this is sadly expected.".format(identifier))
+            if len(working_set) == 0:
+                if len(history_entries) > 0:
+                    logprint("Only skipped entries are left in history, stopping.")
+                break
 
-            continue
+        # Entries deleted concurrently may have been listed again by responses of the last batch.
+        pending_entries = [entry for entry in working_set if not is_excluded(entry)]
+        working_set = HistoryStore()
 
-        entries.append(PuushEntry(identifier, date, url, filename, views, unknown))
+        # Perform deletions concurrently, each returns a history list with its item *supposedly* omitted.
+        for puush, updated_history in engine.delete_entries(pending_entries):
+            if updated_history is None:
+                # Entry was skipped rather than deleted.
+                continue
 
-    return entries
+            deleted += 1
 
+            # Feed new unique entries from the response into the working set.
+            working_set.update(entry for entry in updated_history if not is_excluded(entry))
 
-def get_history():
-    """
-    Puush History API request which returns up to 10 entries, if successful.
-    :return:
-    """
-    return response_texts_to_entries(make_post_request(HISTORY_API, data={"k": config["api_key"]}))
+        if log.isEnabledFor(LOG_LEVELS["DEBUG2"]):
+            log.debug2([str(x) for x in working_set])
 
+    return deleted
 
-def delete_puush_entry(entry: PuushEntry):
+
+def delete_history_pipelined(engine: DeletionEngine, max_deletions: int = None):
     """
-    Puush Deletion API request which deletes a given PuushEntry and
-    returns an updated list of puush (history?) entries.
-    :param entry:
-    :return:
+    Deletes entries listed by the history API until the history is empty,
+    prefetching the next entries while the previous ones are being deleted.
+    :param engine:
+    :param max_deletions:   Stop after (roughly) this many deletions.
+    :return: Amount of deleted entries.
     """
-    if entry.identifier is None:
-        raise Exception("PuushEntry identifier was None!")
+    pipeline = PipelinedDeleter(engine, get_history, is_excluded=is_excluded,
+                                queue_size=get_option("prefetch_queue_size"))
+    results = pipeline.run(max_deletions=max_deletions)
 
-    logprint("Deleting Puush entry \"{name}\" (ID: {ident})...".format(name=entry.filename,
-                                                                       ident=entry.identifier))
+    return sum(1 for entry, updated_history in results if updated_history is not None)
 
-    # Prematurely ipdate list of deleted entries' IDs, as it is used by response_texts_to_entries.
-    DELETED_ENTRIES_IDS.append(puush.identifier)
 
-    # Delete the given puush by id and store the updated list of puush (history?) entries
-    return response_texts_to_entries(make_post_request(
-        DELETION_API, data={"k": config["api_key"], "i": entry.identifier}))
+def given_options(args, options: dict):
+    """
+    :param args:
+    :param options: dict of option: argument destination, e.g. {"--plan": "plan"}.
+    :return: Those of the options that were given on the command line.
+    """
+    return [option for option, dest in options.items() if getattr(args, dest) not in (None, False)]
 
 
-def add_unique_puush_entries(src: list, dst: list, id_blacklist: list):
+def print_status():
     """
-    Adds items from source list to destination list,
-    if they are not already in destination list.
-    :param src:
-    :param dst:
-    :param id_blacklist:
+    Prints what previous runs left behind (journal and sweep progress), without making any requests.
     :return:
     """
-    for src_entry in src:
-        if src_entry.identifier in id_blacklist:
-            log.warning("Skipped adding blacklisted PuushEntry to history: {}".format(str(src_entry)))
-            continue
-
-        if not any(dst_entry.identifier == src_entry.identifier for dst_entry in dst):
-            dst.append(src_entry)
-            log.debug("Added new PuushEntry to history: {}".format(str(src_entry)))
-        else:
-            log.debug2("Skipped adding existing PuushEntry to history: {}".format(str(src_entry)))
+    journal = get_journal() if os.path.isfile(journal_path()) or os.path.isfile(DATABASE_PATH) else None
+
+    if journal is None:
+        print("No deletion journal.")
+    else:
+        counts = journal.status_counts()
+        print("Journal: {} entries ({}).".format(sum(counts.values()), ", ".join(
+            "{} {}".format(count, status) for status, count in sorted(counts.items())) or "empty"))
+
+    state = load_sweep_state()
+    if state is not None:
+        print("Sweep in progress at ID {next_id} (range {min_id}-{max_id}).".format(**state))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Batch deletes ALL your puu.sh images.")
+    parser.add_argument("--version", action="version", version="%(prog)s {}".format(VERSION))
+    parser.add_argument("--status", action="store_true",
+                        help="Show the state left behind by previous runs and exit, without making any requests.")
+    parser.add_argument("--sweep", action="store_true",
+                        help="Delete by walking the sequential ID range instead of re-polling history. Every ID "
+                             "costs a request, so this only pays off if most IDs in the range are yours.")
+    parser.add_argument("--sweep-min-id", type=int, default=None,
+                        help="Lowest ID to sweep down to (default: the lowest listed or journaled entry, "
+                             "then one history window at a time).")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Only delete duplicates: entries whose content is identical to an older entry's.")
+    parser.add_argument("--sync", action="store_true",
+                        help="Report what changed since the last sync (new entries, view counts) with a single request, "
+                             "and only delete anything if combined with filters, --plan or --dedup.")
+    parser.add_argument("--prefetch-thumbnails", action="store_true",
+                        help="Cache the thumbnail of every known entry in thumbnails.pack, without deleting anything.")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Keep listing history in the background while deleting, instead of in turns.")
+    parser.add_argument("--api-keys", nargs="+", default=None, metavar="KEY",
+                        help="Wipe several accounts concurrently, each with its own rate limit budget.")
+    parser.add_argument("--api-key-file", default=None,
+                        help="Like --api-keys, but reads the keys from a file (one per line).")
+    parser.add_argument("--export", default=None, metavar="PATH",
+                        help="Archive the metadata of every listed entry to PATH before it is deleted.")
+    parser.add_argument("--export-format", choices=list(EXPORTERS.keys()), default=None,
+                        help="Export file format (default: guessed from the file extension, else jsonl).")
+    parser.add_argument("--backup", default=None, metavar="DIR",
+                        help="Download every entry's file to DIR, and only delete entries that were backed up.")
+    parser.add_argument("--backup-thumbnails", action="store_true",
+                        help="Also download each entry's thumbnail when backing up.")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="Delete using the asyncio client, with up to async_concurrency requests in flight.")
+    parser.add_argument("--upload", default=None, metavar="DIR",
+                        help="Upload every file in DIR (recursively) instead of deleting, verified by MD5.")
+    parser.add_argument("--upload-manifest", default=str(UPLOAD_MANIFEST_PATH), metavar="PATH",
+                        help="Where to write the path, MD5, URL and ID of every uploaded file (JSON lines).")
+    parser.add_argument("--metrics-port", type=int, default=get_option("metrics_bind_port"),
+                        help="Serve Prometheus metrics on this port (at /metrics) while running.")
+    parser.add_argument("--progress", action="store_true",
+                        help="Show a live progress line with the current rate (and ETA, when sweeping).")
+    parser.add_argument("--trace", default=None, metavar="PATH",
+                        help="Write per-phase timings (network, throttling, parsing, bookkeeping) of every request "
+                             "to PATH as a Chrome trace, e.g. for chrome://tracing or Perfetto.")
+    parser.add_argument("--profile", default=None, metavar="PATH",
+                        help="Profile the run (all threads) with cProfile and dump the stats to PATH.")
+    parser.add_argument("--plan", default=None, metavar="PATH",
+                        help="Work out what would be deleted (and how long it would take) without deleting anything, "
+                             "and save the plan to PATH.")
+    parser.add_argument("--run-plan", default=None, metavar="PATH",
+                        help="Delete the entries of a plan saved by --plan, resuming it if it was interrupted.")
+    parser.add_argument("--older-than", type=datetime.fromisoformat, default=None, metavar="DATE",
+                        help="Only delete entries uploaded before DATE (YYYY-MM-DD[ HH:MM:SS]).")
+    parser.add_argument("--max-views", type=int, default=None,
+                        help="Only delete entries with at most this many views.")
+    parser.add_argument("--filename", dest="filename_glob", default=None, metavar="GLOB",
+                        help="Only delete entries whose filename matches GLOB, e.g. '*.png'.")
+    parser.add_argument("--min-size", type=int, default=None, metavar="BYTES",
+                        help="Only delete entries of at least BYTES (costs a HEAD request per entry).")
+    parser.add_argument("--max-size", type=int, default=None, metavar="BYTES",
+                        help="Only delete entries of at most BYTES (costs a HEAD request per entry).")
+
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
-    if "api_key" not in config:
-        print("Missing config entry: API_KEY, aborting!")
-        exit(1)
-    if config["api_key"] is None:
+    args = parse_args()
+
+    if args.status:
+        print_status()
+        close_journal()
+        exit(0)
+
+    init_logging()
+
+    if args.api_keys is not None or args.api_key_file is not None:
+        # Every account is simply wiped, so refuse anything that would narrow down or wrap the deletions.
+        conflicts = given_options(args, {
+            "--older-than": "older_than", "--max-views": "max_views", "--filename": "filename_glob",
+            "--min-size": "min_size", "--max-size": "max_size", "--backup": "backup", "--export": "export",
+            "--plan": "plan", "--run-plan": "run_plan", "--dedup": "dedup", "--sync": "sync", "--sweep": "sweep",
+            "--pipeline": "pipeline", "--prefetch-thumbnails": "prefetch_thumbnails", "--upload": "upload",
+            "--progress": "progress", "--trace": "trace", "--profile": "profile"})
+        if len(conflicts) > 0:
+            logprint_error("{} can't be used with --api-keys or --api-key-file, aborting!".format(", ".join(conflicts)))
+            exit(1)
+
+        # The multi-account (and async) client needs aiohttp, which takes a while to import.
+        from multi_account import read_api_key_file, run as run_multi_account
+
+        api_keys = list(args.api_keys or [])
+        if args.api_key_file is not None:
+            api_keys += read_api_key_file(args.api_key_file)
+
+        try:
+            summaries = run_multi_account(api_keys, max_retries=get_option("api_max_retries"))
+        finally:
+            close_journal()
+
+        exit(1 if any(summary["error"] is not None for summary in summaries) else 0)
+
+    if get_option("api_key") is None:
         print("Unset config entry: API_KEY, aborting!")
         exit(1)
 
-    # Get history (10 items), in order to get list to start with.
-    try:
-        history_entries = get_history()
+    if args.upload is not None:
+        # The uploader uses the async client, which needs aiohttp.
+        from uploader import upload_directory
 
-        log.info([str(x) for x in history_entries])
-        for entry in history_entries:
-            print(entry)
+        results = upload_directory(args.upload, create_rate_limiter(), max_retries=get_option("api_max_retries"),
+                                   manifest_path=args.upload_manifest)
 
-        # While history holds item, systematically delete them.
-        while True:
-            # Get (hopefully) updated list of items from API.
-            history_entries = get_history()
+        exit(1 if any(result.url is None for result in results) else 0)
 
-            if len(history_entries) == 0:
-                break
+    entry_filter = EntryFilter(older_than=args.older_than, max_views=args.max_views,
+                               filename_glob=args.filename_glob, min_size=args.min_size, max_size=args.max_size)
+
+    # The async client only knows how to wipe the whole history, so it must never stand in for a mode that doesn't.
+    conflicts = given_options(args, {"--plan": "plan", "--run-plan": "run_plan", "--sweep": "sweep",
+                                     "--pipeline": "pipeline", "--dedup": "dedup",
+                                     "--prefetch-thumbnails": "prefetch_thumbnails"})
+    if args.use_async and len(conflicts) > 0:
+        logprint_error("{} can't be used with --async, aborting!".format(", ".join(conflicts)))
+        exit(1)
+
+    # Filtered runs only delete the entries selected by a plan, as history keeps listing the entries they leave alone.
+    filtered = entry_filter != EntryFilter()
+
+    if filtered and (args.use_async or args.run_plan is not None or args.dedup or args.prefetch_thumbnails):
+        logprint_error("Filters can't be used with --async, --run-plan, --dedup or --prefetch-thumbnails, aborting!")
+        exit(1)
 
-            # For every puush entry in current history.
-            for puush in history_entries:
-                try:
-                    # Stagger deletions to not spam API.
-                    time.sleep(config["api_rate_limit_delay_seconds"])
+    if args.sync and (args.use_async or args.backup is not None):
+        logprint_error("--sync can't be used with --async or --backup, aborting!")
+        exit(1)
+
+    downloader = None
+    if args.backup is not None:
+        if args.sweep or args.use_async or args.run_plan is not None or filtered or args.dedup \
+                or args.prefetch_thumbnails:
+            logprint_error("--backup can only be used in the default (history) mode, aborting!")
+            exit(1)
 
-                    if puush.identifier in DELETED_ENTRIES_IDS:
-                        error_msg = "Attempted to delete Puush with ID {ident}, " \
-                                    "but it has already been deleted, skipping and removing from history!".format(
-                                        ident=puush.identifier)
+        downloader = Downloader(args.backup, workers=get_option("deletion_workers"), thumbnails=args.backup_thumbnails)
 
-                        logprint_error(error_msg)
+    exporter = None
+    if args.export is not None:
+        if args.sweep:
+            logprint_error("Warning: --sweep deletes entries by ID without listing them first, "
+                           "so the export will only contain entries that showed up in history responses!")
 
-                        # Skip this iteration of the loop, as it contains flaws.
-                        continue
+        exporter = create_exporter(args.export, args.export_format)
+        ENTRY_LISTENERS.append(exporter.export)
 
-                    # Perform deletion, which returns a history list with this item *supposedly* omitted.
-                    updated_history = delete_puush_entry(puush)
+    if args.metrics_port is not None:
+        start_metrics_server(get_option("metrics_bind_host"), args.metrics_port, status_codes=API_STATUS_CODES)
 
-                    # Add new unique entries to the history.
-                    add_unique_puush_entries(history_entries, updated_history, id_blacklist=DELETED_ENTRIES_IDS)
+    progress = ProgressReporter().start() if args.progress else None
+    trace_writer = start_tracing(args.trace) if args.trace is not None else None
+    profiler = Profiler(args.profile).start() if args.profile is not None else None
+    deleted = 0
 
-                    # Make *EXTRA* sure that deleted entries don't still linger in the list we're iterating.
-                    for entry in history_entries:
-                        if entry.identifier in DELETED_ENTRIES_IDS:
-                            log.warning("Removing already deleted entry {} from history entries!".format(
-                                entry.identifier))
-                            history_entries.pop(history_entries.index(entry))
+    try:
+        rate_limiter = create_rate_limiter()
 
-                    log.debug2([str(x) for x in history_entries])
+        if args.use_async:
+            import asyncio
+            from async_api_client import delete_history as async_delete_history
 
-                except Exception as exc:
-                    log.exception(exc)
-                    print("{}: {}".format(exc.__class__.__name__, str(exc)))
-                    raise
+            deleted = asyncio.run(async_delete_history(rate_limiter, max_retries=get_option("api_max_retries")))
+        else:
+            delete_func = sweep_delete_entry if args.sweep else delete_puush_entry
+            resume_delete_func = sweep_delete_entry
+
+            # Files are downloaded on a pool of their own, so only the API requests are rate limited.
+            with DeletionEngine(delete_func, rate_limiter, workers=get_option("deletion_workers"),
+                                is_transient=is_transient_error, max_retries=get_option("api_max_retries"),
+                                prepare=downloader.confirm if downloader is not None else None,
+                                prepare_workers=downloader.workers if downloader is not None else None) as engine:
+                if downloader is not None:
+                    # Thumbnails are fetched from the API, unlike files, so they have to wait for the rate limiter.
+                    downloader.call_api = engine.call
+
+                list_func = partial(engine.call, get_history)
+
+                if args.sync:
+                    synced = sync_history(list_func)
+                    print_sync(synced)
+                    # Plans and dedup start from the synced listing instead of listing again.
+                    list_func = partial(list, synced.entries)
+
+                if args.plan is not None or filtered:
+                    plan = create_plan(entry_filter, rate=rate_limiter.rate, burst=rate_limiter.burst,
+                                       sweep=args.sweep, min_id=args.sweep_min_id, list_func=list_func)
+                    print_plan(plan, args.plan)
+
+                    if args.plan is not None:
+                        save_plan(plan, args.plan)
+                    else:
+                        deleted += run_plan(engine, plan)
+                elif args.run_plan is not None:
+                    deleted += run_plan(engine, load_plan(args.run_plan), args.run_plan)
+                elif args.dedup:
+                    deleted += deduplicate(engine, list_func=list_func)
+                elif args.prefetch_thumbnails:
+                    prefetch_thumbnails(engine, list_func=list_func)
+                elif not args.sync:
+                    deleted += resume_from_journal(engine, delete_func=resume_delete_func)
+
+                    if args.sweep:
+                        deleted += sweep(engine, min_id=args.sweep_min_id)
+                    elif args.pipeline:
+                        deleted += delete_history_pipelined(engine)
+                    else:
+                        deleted += delete_history(engine)
 
     except Exception as exc:
         log.exception(exc)
         print("{}: {}".format(exc.__class__.__name__, str(exc)))
         raise
 
+    finally:
+        if progress is not None:
+            progress.stop()
+        if profiler is not None:
+            profiler.stop()
+        if trace_writer is not None:
+            stop_tracing(trace_writer)
+        close_journal()
+        close_thumbnail_cache()
+        if exporter is not None:
+            exporter.close()
+        logprint(api_call_summary(deleted))
+        if not args.use_async:
+            logprint("HTTP connections: {connections} opened, {reused} reused over {requests} requests.".format(
+                **get_api_client().connection_stats()))
@@ -0,0 +1,267 @@
+import sys
+import threading
+import time
+from collections import deque
+
+from handlers.log_handler import create_logger
+
+log = create_logger(__name__)
+
+# Upper bounds (seconds) of the request latency histogram buckets.
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# Window (seconds) the current rate is averaged over.
+RATE_WINDOW = 60
+
+
+class Metrics:
+    """
+    Thread-safe run instrumentation: counters, a request latency histogram, current rate and ETA.
+
+    Progress is measured in units of work (deletions, or IDs for a sweep) towards an optional total,
+    which is what the rate and ETA are based on.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.requests = {}
+        self.api_errors = {}
+        self.deletions = 0
+        self.skips = 0
+        self.latency_buckets = {}
+        self.latency_sums = {}
+        self.progress_done = 0
+        self.progress_total = None
+        self.progress_times = deque()
+
+    def observe_request(self, endpoint: str, latency: float):
+        """
+        :param endpoint:
+        :param latency: Request duration in seconds, e.g. from response.elapsed.
+        :return:
+        """
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.latency_sums[endpoint] = self.latency_sums.get(endpoint, 0.0) + latency
+
+            buckets = self.latency_buckets.setdefault(endpoint, [0] * (len(LATENCY_BUCKETS) + 1))
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    buckets[i] += 1
+                    break
+            else:
+                buckets[-1] += 1
+
+    def observe_api_error(self, status_code: str):
+        with self.lock:
+            self.api_errors[status_code] = self.api_errors.get(status_code, 0) + 1
+
+    def _advance(self, amount: int):
+        """
+        Must be called with the lock held.
+        :param amount:
+        :return:
+        """
+        now = time.monotonic()
+        self.progress_done += amount
+        self.progress_times.append((now, self.progress_done))
+
+        while len(self.progress_times) > 1 and self.progress_times[0][0] < now - RATE_WINDOW:
+            self.progress_times.popleft()
+
+    def observe_deletion(self):
+        with self.lock:
+            self.deletions += 1
+
+            if self.progress_total is None:
+                self._advance(1)
+
+    def observe_skip(self):
+        with self.lock:
+            self.skips += 1
+
+    def set_progress_total(self, total: int, done: int = 0):
+        """
+        Switches progress to an explicit unit of work (e.g. IDs to sweep), which makes an ETA available.
+        :param total:
+        :param done:
+        :return:
+        """
+        with self.lock:
+            self.progress_total = total
+            self.progress_done = done
+            self.progress_times.clear()
+
+    def advance(self, amount: int = 1):
+        with self.lock:
+            self._advance(amount)
+
+    def rate(self):
+        """
+        :return: Progress units per second, averaged over the last RATE_WINDOW seconds.
+        """
+        with self.lock:
+            if len(self.progress_times) == 0:
+                return 0.0
+
+            first_time, first_done = self.progress_times[0]
+            last_time, last_done = self.progress_times[-1]
+
+            if len(self.progress_times) == 1 or last_time == first_time:
+                elapsed = time.monotonic() - self.started
+                return last_done / elapsed if elapsed > 0 else 0.0
+
+            return (last_done - first_done) / (last_time - first_time)
+
+    def eta(self):
+        """
+        :return: Estimated seconds left, or None if unknown.
+        """
+        rate = self.rate()
+
+        with self.lock:
+            if self.progress_total is None or rate <= 0:
+                return None
+
+            return max(0, self.progress_total - self.progress_done) / rate
+
+    def render(self, status_codes: dict = None):
+        """
+        Renders all metrics in the Prometheus text exposition format.
+        :param status_codes: Meanings of API status codes, added as a label.
+        :return:
+        """
+        rate = self.rate()
+        eta = self.eta()
+        lines = []
+
+        with self.lock:
+            lines.append("# TYPE psh_requests_total counter")
+            for endpoint, count in sorted(self.requests.items()):
+                lines.append('psh_requests_total{{endpoint="{}"}} {}'.format(endpoint, count))
+
+            lines.append("# TYPE psh_api_errors_total counter")
+            for code, count in sorted(self.api_errors.items()):
+                meaning = (status_codes or {}).get(code, "Unknown")
+                lines.append('psh_api_errors_total{{code="{}",meaning="{}"}} {}'.format(code, meaning, count))
+
+            lines.append("# TYPE psh_deletions_total counter")
+            lines.append("psh_deletions_total {}".format(self.deletions))
+            lines.append("# TYPE psh_skips_total counter")
+            lines.append("psh_skips_total {}".format(self.skips))
+
+            lines.append("# TYPE psh_request_latency_seconds histogram")
+            for endpoint, buckets in sorted(self.latency_buckets.items()):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ["+Inf"], buckets):
+                    cumulative += count
+                    lines.append('psh_request_latency_seconds_bucket{{endpoint="{}",le="{}"}} {}'.format(
+                        endpoint, bound, cumulative))
+                lines.append('psh_request_latency_seconds_sum{{endpoint="{}"}} {}'.format(
+                    endpoint, self.latency_sums[endpoint]))
+                lines.append('psh_request_latency_seconds_count{{endpoint="{}"}} {}'.format(endpoint, cumulative))
+
+            lines.append("# TYPE psh_progress_done gauge")
+            lines.append("psh_progress_done {}".format(self.progress_done))
+            if self.progress_total is not None:
+                lines.append("# TYPE psh_progress_total gauge")
+                lines.append("psh_progress_total {}".format(self.progress_total))
+
+        lines.append("# TYPE psh_rate_per_second gauge")
+        lines.append("psh_rate_per_second {}".format(rate))
+        if eta is not None:
+            lines.append("# TYPE psh_eta_seconds gauge")
+            lines.append("psh_eta_seconds {}".format(eta))
+
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+def start_metrics_server(host: str, port: int, status_codes: dict = None, metrics: Metrics = METRICS):
+    """
+    Serves metrics at http://host:port/metrics in a background thread.
+    :param host:
+    :param port:
+    :param status_codes:    Meanings of API status codes, added as a label.
+    :param metrics:
+    :return: The server, call shutdown() on it to stop serving.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+
+            body = metrics.render(status_codes).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+
+    log.info("Serving metrics on http://%s:%d/metrics", host, server.server_address[1])
+
+    return server
+
+
+def format_duration(seconds: float):
+    seconds = int(seconds)
+
+    return "{:02d}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class ProgressReporter:
+    """
+    Redraws a single terminal status line with progress, rate and ETA at a fixed interval.
+    """
+    def __init__(self, metrics: Metrics = METRICS, interval: float = 1, width: int = 30, stream=sys.stderr):
+        self.metrics = metrics
+        self.interval = interval
+        self.width = width
+        self.stream = stream
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def line(self):
+        metrics = self.metrics
+        status = "{} deleted, {} skipped, {:.2f}/s".format(metrics.deletions, metrics.skips, metrics.rate())
+
+        if metrics.progress_total:
+            fraction = min(1.0, metrics.progress_done / metrics.progress_total)
+            filled = int(fraction * self.width)
+            eta = metrics.eta()
+
+            return "[{}{}] {:5.1f}% {}, ETA {}".format("#" * filled, "." * (self.width - filled), fraction * 100,
+                                                      status, format_duration(eta) if eta is not None else "?")
+
+        return status
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.stream.write("\r\033[K" + self.line())
+            self.stream.flush()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="progress", daemon=True)
+        self.thread.start()
+
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+        if self.thread is not None:
+            self.thread.join()
+            self.stream.write("\r\033[K" + self.line() + "\n")
+            self.stream.flush()
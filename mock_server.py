@@ -0,0 +1,328 @@
+import argparse
+import hashlib
+import random
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from datetime import datetime, timedelta
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from id_index import IdSet
+
+# Date of the (fictional) first upload, every ID is one second newer.
+EPOCH = datetime(2011, 1, 1)
+
+
+def make_png(width: int = 100, height: int = 100):
+    """
+    Creates a blank (white) PNG image.
+    :param width:
+    :param height:
+    :return: PNG bytes.
+    """
+    def chunk(kind: bytes, data: bytes):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    raw = b"".join(b"\0" + b"\xff" * (width * 3) for _ in range(height))
+
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) + \
+        chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b"")
+
+
+THUMBNAIL = make_png()
+
+
+class MockAccount:
+    """
+    A puush account with sequential (but not necessarily contiguous) file identifiers.
+    """
+    def __init__(self, api_key: str, entries: int, first_id: int, id_stride: int = 1):
+        """
+        :param api_key:
+        :param entries:     Amount of files in the account.
+        :param first_id:    Identifier of the oldest file.
+        :param id_stride:   Distance between consecutive identifiers, the gaps belong to other accounts.
+        """
+        self.api_key = api_key
+        self.lock = threading.Lock()
+
+        # Identifiers newest first, like the history API lists them.
+        self.ids = list(range(first_id + (entries - 1) * id_stride, first_id - 1, -id_stride))
+        self.alive = IdSet(self.ids)
+        self.head = 0
+        self.recently_deleted = deque(maxlen=100)
+
+    def history(self, reappear_rate: float = 0, limit: int = 10):
+        """
+        :param reappear_rate:   Chance of an already deleted entry reappearing in the response.
+        :param limit:
+        :return: Up to `limit` newest alive identifiers.
+        """
+        with self.lock:
+            # Skip past deleted identifiers at the front for good.
+            while self.head < len(self.ids) and self.ids[self.head] not in self.alive:
+                self.head += 1
+
+            identifiers = []
+            index = self.head
+            while len(identifiers) < limit and index < len(self.ids):
+                if self.ids[index] in self.alive:
+                    identifiers.append(self.ids[index])
+                index += 1
+
+            if len(self.recently_deleted) > 0 and random.random() < reappear_rate:
+                identifiers[-1:] = [random.choice(self.recently_deleted)]
+
+            return identifiers
+
+    def delete(self, identifier: int):
+        """
+        :param identifier:
+        :return: True if the identifier existed (in this account).
+        """
+        with self.lock:
+            if identifier not in self.alive:
+                return False
+
+            self.alive.discard(identifier)
+            self.recently_deleted.append(identifier)
+
+            return True
+
+    def add(self, identifier: int):
+        with self.lock:
+            self.ids.insert(self.head, identifier)
+            self.alive.add(identifier)
+
+
+class MockPuushServer:
+    """
+    Local stand-in for the puush API, as described in puush_undocumented_api.md.
+
+    Every API key gets its own account of `entries` files, created on first use.
+    Latency, failures (-1 responses) and the "deleted entries reappear" behaviour can be injected.
+    """
+    def __init__(self, entries: int = 1000, latency: float = 0, error_rate: float = 0, reappear_rate: float = 0,
+                 id_stride: int = 1, host: str = "127.0.0.1", port: int = 0):
+        """
+        :param entries:         Files per account.
+        :param latency:         Seconds added to every response.
+        :param error_rate:      Chance of a request failing with -1.
+        :param reappear_rate:   Chance of a deleted entry reappearing in a history response.
+        :param id_stride:       Distance between an account's consecutive identifiers.
+        :param host:
+        :param port:            0 picks a free port.
+        """
+        self.entries = entries
+        self.latency = latency
+        self.error_rate = error_rate
+        self.reappear_rate = reappear_rate
+        self.id_stride = id_stride
+        self.accounts = {}
+        self.accounts_lock = threading.Lock()
+        self.next_first_id = 1000
+        self.requests = 0
+
+        server = self
+
+        class Handler(MockPuushRequestHandler):
+            mock = server
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+
+        return "http://{}:{}".format(host, port)
+
+    @property
+    def api_base_url(self):
+        return "{}/api".format(self.base_url)
+
+    def account(self, api_key: str):
+        with self.accounts_lock:
+            if api_key not in self.accounts:
+                self.accounts[api_key] = MockAccount(api_key, self.entries, self.next_first_id, self.id_stride)
+                self.next_first_id += self.entries * self.id_stride + 1000
+
+            return self.accounts[api_key]
+
+    def new_id(self):
+        with self.accounts_lock:
+            identifier = self.next_first_id
+            self.next_first_id += 1
+
+            return identifier
+
+    def history_line(self, identifier: int):
+        return "{id},{date},{url}/files/{id},file{id}.png,{views},0".format(
+            id=identifier, date=(EPOCH + timedelta(seconds=identifier)).strftime("%Y-%m-%d %H:%M:%S"),
+            url=self.base_url, views=identifier % 100)
+
+    def history_text(self, account: MockAccount):
+        return "0\n" + "".join("{}\n".format(self.history_line(identifier))
+                               for identifier in account.history(self.reappear_rate))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="mock-puush", daemon=True)
+        self.thread.start()
+
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class MockPuushRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, don't let Nagle + delayed ACK add 40ms to every response.
+    disable_nagle_algorithm = True
+    mock = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, body, content_type: str = "text/plain", status: int = 200):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def read_form(self):
+        """
+        :return: (form fields dict, uploaded files dict of name: (filename, bytes))
+        """
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        content_type = self.headers.get("Content-Type", "")
+
+        if content_type.startswith("multipart/form-data"):
+            message = BytesParser().parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+            fields, files = {}, {}
+
+            for part in message.get_payload():
+                name = part.get_param("name", header="content-disposition")
+                filename = part.get_filename()
+
+                if filename is not None:
+                    files[name] = (filename, part.get_payload(decode=True))
+                else:
+                    fields[name] = part.get_payload(decode=True).decode("utf-8")
+
+            return fields, files
+
+        return {key: values[0] for key, values in parse_qs(body.decode("utf-8")).items()}, {}
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        if self.path.startswith("/files/"):
+            identifier = self.path[len("/files/"):]
+            # Deterministic content, a few KiB per file.
+            return self.respond(hashlib.sha256(identifier.encode()).digest() * (64 + int(identifier) % 64),
+                                content_type="application/octet-stream")
+
+        self.respond("Not found", status=404)
+
+    def do_POST(self):
+        mock = self.mock
+        fields, files = self.read_form()
+        mock.requests += 1
+
+        if mock.latency > 0:
+            time.sleep(mock.latency)
+
+        if mock.error_rate > 0 and random.random() < mock.error_rate:
+            return self.respond("-1")
+
+        endpoint = self.path.rstrip("/").rsplit("/", 1)[-1]
+        api_key = fields.get("k")
+
+        if endpoint == "auth":
+            if api_key is None and "e" not in fields:
+                return self.respond("-1")
+
+            return self.respond("1,{},,{}".format(api_key or "mock-api-key", 0))
+
+        if api_key is None:
+            return self.respond("-1")
+
+        account = mock.account(api_key)
+
+        if endpoint == "hist":
+            return self.respond(mock.history_text(account))
+
+        if endpoint == "del":
+            if not account.delete(int(fields.get("i", -1))):
+                return self.respond("-2")
+
+            return self.respond(mock.history_text(account))
+
+        if endpoint == "thumb":
+            if int(fields.get("i", -1)) not in account.alive:
+                return self.respond(b"", content_type="image/png")
+
+            return self.respond(THUMBNAIL, content_type="image/png")
+
+        if endpoint == "up":
+            if "f" not in files:
+                return self.respond("-2")
+
+            filename, content = files["f"]
+            if "c" in fields and fields["c"] != hashlib.md5(content).hexdigest():
+                return self.respond("-3")
+
+            identifier = mock.new_id()
+            account.add(identifier)
+
+            return self.respond("0,{}/files/{},{},{}".format(mock.base_url, identifier, identifier, len(content)))
+
+        self.respond("-1")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Local stand-in for the puush API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--entries", type=int, default=1000, help="Files per account.")
+    parser.add_argument("--latency", type=float, default=0, help="Seconds added to every response.")
+    parser.add_argument("--error-rate", type=float, default=0, help="Chance of a request failing with -1.")
+    parser.add_argument("--reappear-rate", type=float, default=0,
+                        help="Chance of a deleted entry reappearing in history responses.")
+    parser.add_argument("--id-stride", type=int, default=1, help="Distance between an account's sequential IDs.")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    mock_server = MockPuushServer(entries=args.entries, latency=args.latency, error_rate=args.error_rate,
+                                  reappear_rate=args.reappear_rate, id_stride=args.id_stride,
+                                  host=args.host, port=args.port)
+
+    print("Serving mock puush API on {} (set api_base_url to use it)".format(mock_server.api_base_url))
+
+    try:
+        mock_server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        mock_server.stop()
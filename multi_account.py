@@ -0,0 +1,109 @@
+import asyncio
+import time
+
+from async_api_client import delete_history
+from handlers.log_handler import create_logger
+from handlers.rate_limit_handler import create_rate_limiter
+from utils import logprint, logprint_error
+
+log = create_logger(__name__)
+
+
+def read_api_key_file(path: str):
+    """
+    Reads API keys from a file, one key per line. Blank lines and lines starting with # are ignored.
+    :param path:
+    :return: List of API keys.
+    """
+    api_keys = []
+
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+
+            if line and not line.startswith("#"):
+                api_keys.append(line)
+
+    return api_keys
+
+
+def mask_api_key(api_key: str):
+    """
+    :param api_key:
+    :return: API key with all but the last four characters masked, safe for logs.
+    """
+    return "*" * max(0, len(api_key) - 4) + api_key[-4:]
+
+
+async def delete_account(api_key: str, max_retries: int = 0):
+    """
+    Deletes all entries of a single account, with its own rate limit budget.
+    :param api_key:
+    :param max_retries:
+    :return: dict summarising the account's run.
+    """
+    started = time.monotonic()
+    summary = {"account": mask_api_key(api_key), "deleted": 0, "error": None}
+
+    def count_deletion(entry):
+        summary["deleted"] += 1
+
+    try:
+        await delete_history(create_rate_limiter(), max_retries=max_retries, api_key=api_key,
+                             on_deleted=count_deletion)
+    except Exception as exc:
+        log.exception(exc)
+        summary["error"] = "{}: {}".format(exc.__class__.__name__, str(exc))
+
+    summary["elapsed"] = time.monotonic() - started
+
+    return summary
+
+
+async def delete_accounts(api_keys: list, max_retries: int = 0):
+    """
+    Deletes all entries of every account concurrently in one event loop.
+
+    A failing account doesn't stop the others, its error is reported in the summary instead.
+    :param api_keys:
+    :param max_retries:
+    :return: List of per-account summaries.
+    """
+    return await asyncio.gather(*(delete_account(api_key, max_retries=max_retries) for api_key in api_keys))
+
+
+def print_summary(summaries: list, elapsed: float):
+    """
+    Prints per-account and combined throughput.
+    :param summaries:
+    :param elapsed: Wall time of the whole run in seconds.
+    :return:
+    """
+    for summary in summaries:
+        rate = summary["deleted"] / summary["elapsed"] if summary["elapsed"] > 0 else 0
+
+        if summary["error"] is not None:
+            logprint_error("{account}: FAILED after {deleted} deletions: {error}".format(**summary))
+        else:
+            logprint("{}: deleted {} entries in {:.1f}s ({:.2f}/s)".format(
+                summary["account"], summary["deleted"], summary["elapsed"], rate))
+
+    total = sum(summary["deleted"] for summary in summaries)
+    failed = sum(1 for summary in summaries if summary["error"] is not None)
+
+    logprint("Total: deleted {} entries across {} accounts ({} failed) in {:.1f}s ({:.2f}/s)".format(
+        total, len(summaries), failed, elapsed, total / elapsed if elapsed > 0 else 0))
+
+
+def run(api_keys: list, max_retries: int = 0):
+    """
+    Deletes all entries of every given account and prints a combined summary.
+    :param api_keys:
+    :param max_retries:
+    :return: List of per-account summaries.
+    """
+    started = time.monotonic()
+    summaries = asyncio.run(delete_accounts(api_keys, max_retries=max_retries))
+    print_summary(summaries, time.monotonic() - started)
+
+    return summaries
@@ -0,0 +1,247 @@
+import json
+import os
+from datetime import datetime
+from itertools import islice
+
+from deletion_engine import DeletionEngine
+from downloader import remote_size
+from entry_filter import EntryFilter
+from handlers.db_handler import account_hash, check_account, get_journal
+from handlers.log_handler import create_logger
+from metrics import METRICS
+from puush_api import DELETED_ENTRIES_IDS, SKIPPED_ENTRIES_IDS, get_history
+from puush_entry import PuushEntry
+from sweep import sweep_delete_entry
+from sync import known_entries
+from utils import logprint
+
+log = create_logger(__name__)
+
+PLAN_VERSION = 1
+
+
+def id_ranges(identifiers):
+    """
+    Compacts identifiers into runs of consecutive IDs, which is what keeps sweep plans small on disk.
+    :param identifiers:
+    :return: List of [highest, lowest] pairs, from the highest ID down.
+    """
+    ranges = []
+
+    for identifier in sorted(set(identifiers), reverse=True):
+        if len(ranges) > 0 and ranges[-1][1] - 1 == identifier:
+            ranges[-1][1] = identifier
+        else:
+            ranges.append([identifier, identifier])
+
+    return ranges
+
+
+def iter_plan_ids(plan: dict, start: int = 0):
+    """
+    :param plan:
+    :param start:   Amount of IDs to skip, e.g. the position of an interrupted run.
+    :return: Generator of the planned IDs, from the highest down.
+    """
+    for highest, lowest in plan["ranges"]:
+        size = highest - lowest + 1
+
+        if start >= size:
+            start -= size
+            continue
+
+        yield from range(highest - start, lowest - 1, -1)
+        start = 0
+
+
+def save_plan(plan: dict, plan_path: str):
+    """
+    Atomically saves a plan, so that an interrupted run can be resumed.
+    :param plan:
+    :param plan_path:
+    :return:
+    """
+    tmp_path = "{}.tmp".format(plan_path)
+
+    with open(tmp_path, 'w') as f:
+        json.dump(plan, f, separators=(",", ":"))
+
+    os.replace(tmp_path, plan_path)
+
+
+def load_plan(plan_path: str):
+    with open(plan_path) as f:
+        plan = json.load(f)
+
+    if plan.get("version") != PLAN_VERSION:
+        raise Exception("Unsupported plan version {} in {}!".format(plan.get("version"), plan_path))
+
+    return plan
+
+
+def estimate_seconds(requests: int, rate: float, burst: int):
+    """
+    :param requests:
+    :param rate:    Requests per second.
+    :param burst:   Requests that can be made up front.
+    :return: Least amount of seconds the requests take under the rate budget.
+    """
+    return max(0, requests - burst) / rate
+
+
+def query_entries(entries, entry_filter: EntryFilter, min_id: int = None, max_id: int = None):
+    """
+    Selects the candidates matching the filter's metadata predicates, in a single indexed journal query
+    if journaling is enabled (listed entries are journaled as they're parsed), else from the given entries.
+    :param entries:
+    :param entry_filter:
+    :param min_id:
+    :param max_id:
+    :return: List of matching entries.
+    """
+    journal = get_journal()
+    if journal is not None:
+        return journal.query_entries(entry_filter, min_id=min_id, max_id=max_id)
+
+    metadata_filter = entry_filter._replace(min_size=None, max_size=None)
+
+    return [entry for entry in entries
+            if (min_id is None or entry.identifier >= min_id) and (max_id is None or entry.identifier <= max_id)
+            and metadata_filter.matches(entry)]
+
+
+def select_entries(entries, entry_filter: EntryFilter):
+    """
+    :param entries:         Entries matching the filter's metadata predicates, e.g. as given by query_entries.
+    :param entry_filter:
+    :return: (list of matching identifiers, amount of requests made to determine file sizes)
+    """
+    size_filter = EntryFilter(min_size=entry_filter.min_size, max_size=entry_filter.max_size)
+    selected = []
+    requests = 0
+
+    for entry in entries:
+        if entry.identifier in DELETED_ENTRIES_IDS or entry.identifier in SKIPPED_ENTRIES_IDS:
+            continue
+
+        if size_filter.needs_size():
+            if entry.url is None:
+                continue
+
+            requests += 1
+            if not size_filter.matches(entry, remote_size(entry.url)):
+                continue
+
+        selected.append(entry.identifier)
+
+    return selected, requests
+
+
+def create_plan(entry_filter: EntryFilter, rate: float, burst: int, sweep: bool = False, min_id: int = None,
+                list_func=get_history):
+    """
+    Determines what a run would delete, without deleting anything.
+
+    The history API only ever lists the newest entries, so the candidates are those, plus the entries journaled
+    by previous runs. A sweep plan instead covers every ID from the newest entry down to min_id (or the oldest
+    listed entry), though only IDs with journaled metadata can be checked against metadata filters.
+    :param entry_filter:
+    :param rate:    Deletion requests per second.
+    :param burst:
+    :param sweep:   Plan the sequential ID range instead of the listed entries.
+    :param min_id:  Lowest ID of a sweep plan.
+    :param list_func:   See known_entries.
+    :return: Plan dict.
+    """
+    journal = get_journal()
+    if journal is not None:
+        DELETED_ENTRIES_IDS.update(journal.deleted_ids())
+
+    entries = known_entries(list_func)
+    # Listing the newest entries takes a single history request.
+    discovery_requests = 1
+
+    if sweep and len(entries) > 0:
+        identifiers = [entry.identifier for entry in entries]
+        highest = max(identifiers)
+        lowest = min(identifiers) if min_id is None else min(min_id, min(identifiers))
+
+        if entry_filter.needs_metadata():
+            selected, size_requests = select_entries(
+                query_entries(entries, entry_filter, min_id=lowest, max_id=highest), entry_filter)
+        else:
+            selected, size_requests = [identifier for identifier in range(highest, lowest - 1, -1)
+                                       if identifier not in DELETED_ENTRIES_IDS], 0
+    else:
+        selected, size_requests = select_entries(query_entries(entries, entry_filter), entry_filter)
+
+    discovery_requests += size_requests
+    ranges = id_ranges(selected)
+
+    return {
+        "version": PLAN_VERSION,
+        "account": account_hash(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "mode": "sweep" if sweep else "history",
+        "filters": entry_filter.to_dict(),
+        "count": len(selected),
+        "discovery_requests": discovery_requests,
+        "estimated_seconds": estimate_seconds(len(selected), rate, burst),
+        "position": 0,
+        "ranges": ranges
+    }
+
+
+def print_plan(plan: dict, plan_path: str = None):
+    logprint("Planned {count} deletions ({mode} mode, filters: {filters}) in {ranges} ID ranges{saved}.".format(
+        count=plan["count"], mode=plan["mode"], filters=plan["filters"] or "none", ranges=len(plan["ranges"]),
+        saved=", saved to {}".format(plan_path) if plan_path is not None else ""))
+    logprint("Planning took {} API requests, running the plan takes at least {} requests and {:.0f} seconds "
+             "under the configured rate limit.".format(plan["discovery_requests"], plan["count"],
+                                                       plan["estimated_seconds"]))
+
+
+def run_plan(engine: DeletionEngine, plan: dict, plan_path: str = None, chunk_size: int = 100):
+    """
+    Deletes the IDs of a saved plan, without listing anything first.
+
+    Progress is saved to the plan after every chunk, and a partially run plan is resumed where it left off.
+    :param engine:
+    :param plan:
+    :param plan_path:   Path to save progress to, if any.
+    :param chunk_size:  Amount of IDs to delete between each progress save.
+    :return: Amount of deleted entries.
+    """
+    check_account(plan, plan_path if plan_path is not None else "The plan")
+
+    journal = get_journal()
+    if journal is not None:
+        DELETED_ENTRIES_IDS.update(journal.deleted_ids())
+
+    if plan["position"] > 0:
+        logprint("Resuming plan at {} of {} IDs.".format(plan["position"], plan["count"]))
+
+    METRICS.set_progress_total(plan["count"], done=plan["position"])
+    identifiers = iter_plan_ids(plan, plan["position"])
+    deleted = 0
+
+    while plan["position"] < plan["count"]:
+        chunk = [PuushEntry(identifier) for identifier in islice(identifiers, chunk_size)]
+        if len(chunk) == 0:
+            break
+
+        pending = [entry for entry in chunk
+                   if entry.identifier not in DELETED_ENTRIES_IDS and entry.identifier not in SKIPPED_ENTRIES_IDS]
+
+        for entry, updated_history in engine.delete_entries(pending, delete_func=sweep_delete_entry):
+            if updated_history is not None:
+                deleted += 1
+
+        plan["position"] += len(chunk)
+        if plan_path is not None:
+            save_plan(plan, plan_path)
+        METRICS.advance(len(chunk))
+
+    logprint("Plan finished, deleted {} entries.".format(deleted))
+
+    return deleted
@@ -0,0 +1,263 @@
+import threading
+import time
+from collections import Counter
+
+from api_client import get_api_client
+from handlers.config_handler import get_option
+from handlers.db_handler import get_journal
+from handlers.log_handler import create_logger
+from id_index import IdSet
+from metrics import METRICS
+from puush_entry import PuushEntry
+from response_parser import iter_history_entries, split_status
+from tracing import SPAN_HOOKS, emit_response_spans, span
+from utils import logprint_request, logprint_response, logprint
+
+log = create_logger(__name__)
+
+# API endpoints, relative to the configured api_base_url.
+AUTH_API = "/auth"
+HISTORY_API = "/hist"
+DELETION_API = "/del"
+THUMBNAIL_API = "/thumb"
+UPLOAD_API = "/up"
+
+# Status code returned for IDs that don't exist (anymore), e.g. when a delete is resent after it went through.
+NOT_FOUND_STATUS_CODE = "-2"
+
+API_STATUS_CODES = {
+    "0": "Success",
+    "-1": "General failure",
+    "-2": "Failure: A requested property was not found",
+    "-3": "Failure: Hash mismatch"
+}
+
+DELETED_ENTRIES_IDS = IdSet()
+
+# Entries that must be left alone for the rest of the run, e.g. because they couldn't be backed up.
+SKIPPED_ENTRIES_IDS = IdSet()
+
+# Amount of API calls made per endpoint.
+API_CALL_COUNTS = Counter()
+API_CALL_COUNTS_LOCK = threading.Lock()
+
+# Callables that are handed every list of entries parsed from an API response, e.g. exporters.
+ENTRY_LISTENERS = []
+
+
+def count_api_call(api_endpoint: str):
+    with API_CALL_COUNTS_LOCK:
+        API_CALL_COUNTS[api_endpoint] += 1
+
+
+def api_call_summary(deleted: int):
+    """
+    :param deleted: Amount of deleted entries.
+    :return: Human readable summary of the API calls made, relative to the amount of deleted entries.
+    """
+    with API_CALL_COUNTS_LOCK:
+        total = sum(API_CALL_COUNTS.values())
+        per_endpoint = ", ".join("{}: {}".format(endpoint.lstrip("/"), count)
+                                 for endpoint, count in sorted(API_CALL_COUNTS.items()))
+
+    return "Deleted {} entries using {} API calls ({}), {} calls per deleted entry.".format(
+        deleted, total, per_endpoint or "none",
+        "{:.2f}".format(total / deleted) if deleted > 0 else "n/a")
+
+
+class PuushApiError(Exception):
+    """
+    Raised when the puush API responds with a non-zero status code.
+    """
+    def __init__(self, status_code: str, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+# Status codes that may succeed when retried.
+TRANSIENT_STATUS_CODES = ["-1"]
+TRANSIENT_HTTP_STATUS_CODES = [429, 500, 502, 503, 504]
+
+
+def is_transient_error(exc: Exception):
+    """
+    Determines whether a failed API request is worth retrying.
+    :param exc:
+    :return:
+    """
+    import requests
+
+    if isinstance(exc, PuushApiError):
+        return exc.status_code in TRANSIENT_STATUS_CODES
+
+    if isinstance(exc, requests.HTTPError):
+        return exc.response is not None and exc.response.status_code in TRANSIENT_HTTP_STATUS_CODES
+
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout))
+
+
+def raise_for_status_code(status_code: str):
+    """
+    Raises PuushApiError for non-zero API status codes.
+    :param status_code:
+    :return:
+    """
+    if status_code != "0":
+        METRICS.observe_api_error(status_code)
+        error_info = "Got non-zero return code {}".format(status_code)
+
+        # If status code is known, append its meaning.
+        if status_code in API_STATUS_CODES:
+            error_info += ": {}".format(API_STATUS_CODES[status_code])
+
+        raise PuushApiError(status_code, "{}, aborting!".format(error_info))
+
+
+def make_raw_post_request(api_endpoint: str, data: dict):
+    """
+    Makes a HTTP POST request to an API endpoint, with an optional data payload,
+    and checks the status code on the first line of the response.
+    :param api_endpoint:
+    :param data:
+    :return: (raw response body, offset of the first byte after the status line)
+    """
+    client = get_api_client()
+    count_api_call(api_endpoint)
+
+    started = time.perf_counter()
+    with span(api_endpoint, "http", endpoint=api_endpoint):
+        response = client.post(api_endpoint, data=data)
+
+    if SPAN_HOOKS:
+        emit_response_spans(api_endpoint, started, response)
+
+    METRICS.observe_request(api_endpoint, response.elapsed.total_seconds())
+    logprint_request(client.resolve_url(api_endpoint))
+
+    logprint_response(response)
+    log.debug("Response dict:\n%s", response.__dict__)
+
+    # Surface HTTP level errors (e.g. throttling) before trying to parse the body.
+    if response.status_code >= 400:
+        METRICS.observe_api_error("HTTP {}".format(response.status_code))
+    response.raise_for_status()
+
+    content = response.content
+    log.info("Response body: %r", content)
+
+    # The first line of the response is a status code.
+    status_code, body_start = split_status(content)
+    raise_for_status_code(status_code)
+
+    return content, body_start
+
+
+def collect_entries(entries, api_key: str = None):
+    """
+    Collects parsed entries into a list, skipping (and warning about) already deleted ones.
+    :param entries: Iterable of PuushEntry.
+    :param api_key: Account the entries were listed for, defaults to the one in config.
+    :return:
+    """
+    collected = []
+
+    for entry in entries:
+        if entry.identifier in DELETED_ENTRIES_IDS:
+            log.warning("SKIPPING already deleted entry %s from unsanitary API response! "
+                        "The API is untrustworthy, this is sadly expected.", entry.identifier)
+
+            continue
+
+        collected.append(entry)
+
+    journal = get_journal(api_key)
+    if journal is not None:
+        with span("journal entries", "bookkeeping", entries=len(collected)):
+            journal.record_seen(collected)
+
+    for listener in ENTRY_LISTENERS:
+        with span(getattr(listener, "__qualname__", repr(listener)), "bookkeeping", entries=len(collected)):
+            listener(collected)
+
+    return collected
+
+
+def response_bytes_to_entries(content: bytes, start: int = 0):
+    """
+    Creates a list of PuushEntry objects straight from raw response bytes.
+    :param content:
+    :param start:   Offset of the first history line, e.g. as returned by make_raw_post_request.
+    :return:
+    """
+    with span("parse history", "parse", bytes=len(content) - start):
+        return collect_entries(iter_history_entries(content, start))
+
+
+def get_history():
+    """
+    Puush History API request which returns up to 10 entries, if successful.
+    :return:
+    """
+    return response_bytes_to_entries(*make_raw_post_request(HISTORY_API, data={"k": get_option("api_key")}))
+
+
+def get_thumbnail(identifier: int):
+    """
+    Puush Thumbnail API request which returns the 100x100 PNG thumbnail of an entry.
+    :param identifier:
+    :return: PNG bytes, or None if the API responded with nothing (e.g. for files that aren't images).
+    """
+    client = get_api_client()
+    count_api_call(THUMBNAIL_API)
+    response = client.post(THUMBNAIL_API, data={"k": get_option("api_key"), "i": identifier})
+    METRICS.observe_request(THUMBNAIL_API, response.elapsed.total_seconds())
+    response.raise_for_status()
+
+    return response.content if len(response.content) > 0 else None
+
+
+def record_deletion(identifier: int, api_key: str = None):
+    """
+    Journals and counts a deleted entry, whichever client deleted it.
+    :param identifier:
+    :param api_key:     Account the entry belonged to, defaults to the one in config.
+    :return:
+    """
+    journal = get_journal(api_key)
+    if journal is not None:
+        journal.mark_deleted(identifier)
+
+    METRICS.observe_deletion()
+
+
+def delete_puush_entry(entry: PuushEntry):
+    """
+    Puush Deletion API request which deletes a given PuushEntry and
+    returns an updated list of puush (history?) entries.
+    :param entry:
+    :return:
+    """
+    if entry.identifier is None:
+        raise Exception("PuushEntry identifier was None!")
+
+    logprint("Deleting Puush entry \"{name}\" (ID: {ident})...".format(name=entry.filename,
+                                                                       ident=entry.identifier))
+
+    # Prematurely update list of deleted entries' IDs, as it is used by collect_entries.
+    DELETED_ENTRIES_IDS.add(entry.identifier)
+
+    # Delete the given puush by id and store the updated list of puush (history?) entries
+    try:
+        history = response_bytes_to_entries(*make_raw_post_request(
+            DELETION_API, data={"k": get_option("api_key"), "i": entry.identifier}))
+    except PuushApiError as exc:
+        if exc.status_code != NOT_FOUND_STATUS_CODE:
+            raise
+
+        # The entry was listed, so it's gone: most likely a resent delete whose first attempt went through.
+        log.warning("Puush entry %s was already deleted, assuming an earlier attempt succeeded.", entry.identifier)
+        history = []
+
+    record_deletion(entry.identifier)
+
+    return history
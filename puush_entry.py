@@ -1,18 +1,19 @@
-class PuushEntry:
-    identifier = None
-    date = None
-    url = None
-    filename = None
-    views = None
-    unknown = None
+from datetime import datetime
+from typing import NamedTuple, Optional
 
-    def __init__(self, identifier, date, url, filename, views, unknown=0):
-        self.identifier = identifier
-        self.date = date
-        self.url = url
-        self.filename = filename
-        self.views = views
-        self.unknown = unknown
+
+class PuushEntry(NamedTuple):
+    """
+    A single puush history entry.
+
+    Being a NamedTuple it has no per-instance __dict__, which keeps large history snapshots compact.
+    """
+    identifier: int
+    date: Optional[datetime] = None
+    url: Optional[str] = None
+    filename: Optional[str] = None
+    views: Optional[int] = None
+    unknown: Optional[str] = "0"
 
     def __str__(self):
         return "<{}: identifier={}, date={},url={}, filename={}, views={}, unknown={}>".format(
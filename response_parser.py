@@ -0,0 +1,166 @@
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+from handlers.log_handler import create_logger
+from puush_entry import PuushEntry
+
+log = create_logger(__name__)
+
+
+class ResponseParseError(ValueError):
+    """
+    Raised when (part of) an API response doesn't have the documented shape.
+    """
+    pass
+
+
+def split_status(content: bytes):
+    """
+    Splits the status code off a raw API response, without copying the rest of the body.
+    :param content:
+    :return: (status code, offset of the first byte after the status line)
+    """
+    newline = content.find(b'\n')
+
+    if newline == -1:
+        return content.decode('utf-8', errors='replace').strip(), len(content)
+
+    return content[:newline].decode('utf-8', errors='replace').strip(), newline + 1
+
+
+def iter_lines(content: bytes, start: int = 0):
+    """
+    Lazily decodes the non-empty lines of a raw response body, one line at a time.
+    :param content: Raw response body.
+    :param start:   Offset to start at, e.g. the offset after the status line.
+    :return: Generator of str, without line endings.
+    """
+    end = len(content)
+
+    while start < end:
+        newline = content.find(b'\n', start)
+        if newline == -1:
+            newline = end
+
+        if newline > start:
+            line = content[start:newline].decode('utf-8', errors='replace').strip('\r')
+
+            if line:
+                yield line
+
+        start = newline + 1
+
+
+def parse_history_line(line: str):
+    """
+    Parses a single history line: `{id},{YYYY-MM-DD HH:MM:SS},{url},{filename},{views},{unknown}`.
+
+    The filename is the only free-form field, so it is whatever is left between the url and the
+    last two fields, commas included.
+    :param line:
+    :return: PuushEntry
+    """
+    fields = line.split(',', 3)
+    if len(fields) != 4:
+        raise ResponseParseError("Malformed history line: {!r}".format(line))
+
+    identifier, date, url, rest = fields
+
+    fields = rest.rsplit(',', 2)
+    if len(fields) != 3:
+        raise ResponseParseError("Malformed history line: {!r}".format(line))
+
+    filename, views, unknown = fields
+
+    try:
+        return PuushEntry(int(identifier), datetime.fromisoformat(date), url, filename, int(views), unknown)
+    except ValueError as exc:
+        raise ResponseParseError("Malformed history line: {!r} ({})".format(line, exc)) from exc
+
+
+def parse_history_lines(lines):
+    """
+    Lazily parses history lines, skipping empty ones.
+
+    Malformed lines are logged and skipped, so that one odd line doesn't throw away the rest of the response.
+    :param lines:   Iterable of str.
+    :return: Generator of PuushEntry.
+    """
+    for line in lines:
+        if line == "":
+            continue
+
+        try:
+            yield parse_history_line(line)
+        except ResponseParseError as exc:
+            log.warning("Skipping unparsable history line: %s", exc)
+
+
+def iter_history_entries(content: bytes, start: int = 0):
+    """
+    Lazily parses PuushEntry objects straight from raw response bytes, one line at a time.
+    :param content: Raw response body.
+    :param start:   Offset to start parsing at, e.g. the offset after the status line.
+    :return: Generator of PuushEntry.
+    """
+    return parse_history_lines(iter_lines(content, start))
+
+
+class AuthInfo(NamedTuple):
+    premium: bool
+    api_key: str
+    expiry: Optional[str]
+    size_sum: int
+
+
+class UploadResult(NamedTuple):
+    url: str
+    identifier: int
+    size: int
+
+
+def parse_auth_response(text: str):
+    """
+    Parses an authentication response: `{premium},{apikey},[expire],{size-sum}`, or a bare failure status code.
+    :param text:
+    :return: (status code, AuthInfo or None)
+    """
+    text = text.strip()
+
+    if "," not in text:
+        return text, None
+
+    fields = text.split(',', 2)
+    if len(fields) != 3:
+        raise ResponseParseError("Malformed auth response: {!r}".format(text))
+
+    premium, api_key, rest = fields
+    expiry, _, size_sum = rest.rpartition(',')
+
+    try:
+        return "0", AuthInfo(premium == "1", api_key, expiry or None, int(size_sum))
+    except ValueError as exc:
+        raise ResponseParseError("Malformed auth response: {!r}".format(text)) from exc
+
+
+def parse_upload_response(text: str):
+    """
+    Parses an upload response: `0,{url},{id},{size}`, or a bare failure status code.
+    :param text:
+    :return: (status code, UploadResult or None)
+    """
+    status_code, _, rest = text.strip().partition(',')
+
+    if status_code != "0":
+        return status_code, None
+
+    fields = rest.rsplit(',', 2)
+    if len(fields) != 3:
+        raise ResponseParseError("Malformed upload response: {!r}".format(text))
+
+    url, identifier, size = fields
+
+    try:
+        return "0", UploadResult(url, int(identifier), int(size))
+    except ValueError as exc:
+        raise ResponseParseError("Malformed upload response: {!r}".format(text)) from exc
@@ -1,10 +1,15 @@
 import pathlib
 
+VERSION = "0.2.0"
+
 # Get directory this file resides in (should be the project root directory).
 PROJECT_ROOT_DIR = pathlib.Path(__file__).parent.absolute()
 DATABASE_FILENAME = 'sane-psh.db'
 DATABASE_PATH = PROJECT_ROOT_DIR.joinpath(DATABASE_FILENAME)
 CONFIG_PATH = PROJECT_ROOT_DIR.joinpath('config.json')
+SWEEP_STATE_PATH = PROJECT_ROOT_DIR.joinpath('sweep-state.json')
+UPLOAD_MANIFEST_PATH = PROJECT_ROOT_DIR.joinpath('upload-manifest.jsonl')
+THUMBNAIL_PACK_PATH = PROJECT_ROOT_DIR.joinpath('thumbnails.pack')
 SAMPLE_CONFIG_PATH = PROJECT_ROOT_DIR.joinpath('config.json.sample')
 LOG_DIR = PROJECT_ROOT_DIR.joinpath('logs')
-LOG_FILE = LOG_DIR.joinpath('sane-psh.log')
\ No newline at end of file
+LOG_FILE = LOG_DIR.joinpath('sane-psh.log')
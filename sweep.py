@@ -0,0 +1,218 @@
+import json
+import os
+
+from deletion_engine import DeletionEngine
+from handlers.config_handler import get_option
+from handlers.db_handler import account_hash, check_account, get_journal
+from handlers.log_handler import create_logger
+from metrics import METRICS
+from puush_api import DELETION_API, DELETED_ENTRIES_IDS, NOT_FOUND_STATUS_CODE, PuushApiError, \
+    get_history, make_raw_post_request, record_deletion, response_bytes_to_entries
+from puush_entry import PuushEntry
+from settings import SWEEP_STATE_PATH
+from utils import logprint
+
+log = create_logger(__name__)
+
+
+def load_sweep_state(state_path=SWEEP_STATE_PATH):
+    """
+    Loads saved sweep progress, if any.
+    :param state_path:
+    :return: dict with account, max_id, min_id and next_id, or None.
+    """
+    if not os.path.isfile(state_path):
+        return None
+
+    with open(state_path) as f:
+        return json.load(f)
+
+
+def save_sweep_state(state: dict, state_path=SWEEP_STATE_PATH):
+    """
+    Atomically saves sweep progress, so that an interrupted sweep can be resumed.
+    :param state:
+    :param state_path:
+    :return:
+    """
+    tmp_path = "{}.tmp".format(state_path)
+
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=4)
+
+    os.replace(tmp_path, state_path)
+
+
+def clear_sweep_state(state_path=SWEEP_STATE_PATH):
+    if os.path.isfile(state_path):
+        os.remove(state_path)
+
+
+def find_id_bounds():
+    """
+    Determines the upper bound of the sweep from a single history call.
+    :return: (lowest, highest) identifier in the history, or None if the history is empty.
+    """
+    identifiers = [entry.identifier for entry in get_history()]
+
+    if len(identifiers) == 0:
+        return None
+
+    return min(identifiers), max(identifiers)
+
+
+def sweep_delete_entry(entry: PuushEntry):
+    """
+    Deletes an entry by identifier, treating a "not found" response as a cheap skip instead of a failure.
+
+    :param entry:
+    :return: Updated history list if the entry was deleted, None if it didn't exist (or isn't ours).
+    """
+    try:
+        history = response_bytes_to_entries(*make_raw_post_request(
+            DELETION_API, data={"k": get_option("api_key"), "i": entry.identifier}))
+    except PuushApiError as exc:
+        if exc.status_code == NOT_FOUND_STATUS_CODE:
+            journal = get_journal()
+            if journal is not None and entry.date is not None:
+                # Only journal entries we've actually seen, not every foreign ID the sweep walks past.
+                journal.mark_missing(entry.identifier)
+
+            log.debug("Sweep: ID %s does not exist or is not ours, skipping.", entry.identifier)
+            return None
+        raise
+
+    DELETED_ENTRIES_IDS.add(entry.identifier)
+    record_deletion(entry.identifier)
+    logprint("Sweep: Deleted Puush entry with ID {}.".format(entry.identifier))
+
+    return history
+
+
+def new_sweep_state(min_id: int = None):
+    """
+    Creates sweep state for the ID window given by a single history call.
+
+    Without min_id, the window reaches down to the lowest entry journaled by previous runs, if that is lower
+    than the lowest listed entry, so that the history doesn't have to be polled again every 10 entries.
+    :param min_id:
+    :return: Sweep state dict, or None if the history is empty.
+    """
+    bounds = find_id_bounds()
+
+    if bounds is None:
+        return None
+
+    lowest, highest = bounds
+
+    journal = get_journal()
+    if min_id is None and journal is not None:
+        lowest_pending_id = journal.lowest_pending_id()
+
+        if lowest_pending_id is not None:
+            lowest = min(lowest, lowest_pending_id)
+
+    return {"account": account_hash(),
+            "max_id": highest,
+            "min_id": lowest if min_id is None else min(min_id, lowest),
+            "next_id": highest}
+
+
+def sweep_window(engine: DeletionEngine, state: dict, chunk_size: int, state_path):
+    """
+    Deletes every ID in the window described by state, from the top down.
+    :param engine:
+    :param state:
+    :param chunk_size:
+    :param state_path:
+    :return: (amount of deleted entries, whether a deletion reported an empty history)
+    """
+    deleted = 0
+
+    # Sweep progress is measured in IDs, as the amount of entries in the window isn't known up front.
+    METRICS.set_progress_total(state["max_id"] - state["min_id"] + 1, done=state["max_id"] - state["next_id"])
+
+    while state["next_id"] >= state["min_id"]:
+        chunk_end = max(state["min_id"], state["next_id"] - chunk_size + 1)
+        chunk = [PuushEntry(identifier)
+                 for identifier in range(state["next_id"], chunk_end - 1, -1)]
+
+        account_emptied = False
+        for entry, updated_history in engine.delete_entries(chunk):
+            if updated_history is None:
+                continue
+
+            deleted += 1
+            if len(updated_history) == 0:
+                account_emptied = True
+
+        state["next_id"] = chunk_end - 1
+        save_sweep_state(state, state_path)
+        METRICS.advance(len(chunk))
+
+        if account_emptied:
+            return deleted, True
+
+    return deleted, False
+
+
+def sweep(engine: DeletionEngine, min_id: int = None, chunk_size: int = 100, state_path=SWEEP_STATE_PATH):
+    """
+    Deletes entries by walking the sequential ID range downwards, instead of re-polling history.
+
+    The upper bound of a window is the highest ID in the history, the lower bound is either min_id or
+    (if not given) the lowest ID in the history or journal, in which case a new window is fetched once the current
+    one is exhausted.
+
+    Every ID in the range costs a deletion request, whether or not it is ours. Sweeping only pays off when the
+    account's IDs are dense, on a range shared with other accounts the default mode takes fewer requests.
+    The sweep stops as soon as a deletion responds with an empty history, as that means the account has been emptied.
+
+    Progress is saved after every chunk, and a saved sweep is resumed where it left off.
+    :param engine:      DeletionEngine to perform the deletions with.
+    :param min_id:      Lowest ID to sweep down to.
+    :param chunk_size:  Amount of IDs to delete between each progress save.
+    :param state_path:  Path of the progress file.
+    :return: Amount of deleted entries.
+    """
+    state = load_sweep_state(state_path)
+    deleted = 0
+
+    if state is not None:
+        # The ID range of another account's sweep would just be walked again with this account's key.
+        check_account(state, state_path)
+        logprint("Resuming sweep at ID {next_id} (range {min_id}-{max_id}).".format(**state))
+
+    while True:
+        if state is None:
+            state = new_sweep_state(min_id)
+
+            if state is None:
+                logprint("Sweep: History is empty, account has been emptied.")
+                break
+
+            save_sweep_state(state, state_path)
+            logprint("Sweeping ID range {min_id}-{max_id}.".format(**state))
+
+        window_deleted, account_emptied = sweep_window(engine, state, chunk_size, state_path)
+        deleted += window_deleted
+
+        if account_emptied:
+            logprint("Sweep: History is empty, account has been emptied.")
+            break
+
+        if min_id is not None:
+            break
+
+        if window_deleted == 0:
+            # The history keeps listing entries that can't be deleted, avoid sweeping the same window forever.
+            logprint("Sweep: Nothing left to delete in ID range {min_id}-{max_id}, stopping.".format(**state))
+            break
+
+        # Window exhausted, fetch the next one from history.
+        state = None
+
+    clear_sweep_state(state_path)
+    logprint("Sweep finished, deleted {} entries.".format(deleted))
+
+    return deleted
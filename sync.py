@@ -0,0 +1,105 @@
+from typing import NamedTuple
+
+from handlers.db_handler import get_journal
+from handlers.log_handler import create_logger
+from id_index import HistoryStore
+from puush_api import get_history
+from utils import logprint, logprint_error
+
+log = create_logger(__name__)
+
+# Amount of (newest) entries the history API lists.
+HISTORY_PAGE_SIZE = 10
+
+
+class SyncResult(NamedTuple):
+    entries: list
+    new_entries: list
+    view_deltas: dict
+    removed: list
+    high_water_mark: int
+    # Whether there may be new uploads below the listed ones, which the history API can't show.
+    truncated: bool
+
+
+def diff_snapshot(entries: list, snapshot: dict, high_water_mark: int = None):
+    """
+    Compares the listed entries against the snapshot of the last sync.
+
+    History always lists the newest entries, so every snapshotted entry from the lowest listed ID up
+    that isn't listed anymore is gone.
+    :param entries:         Listed entries.
+    :param snapshot:        dict of identifier: view count, from the lowest listed ID up (or all, if none are listed).
+    :param high_water_mark: Highest ID seen by the last sync, if any.
+    :return: SyncResult
+    """
+    listed = {entry.identifier for entry in entries}
+    new_entries = [entry for entry in entries if high_water_mark is None or entry.identifier > high_water_mark]
+    view_deltas = {entry.identifier: entry.views - snapshot[entry.identifier] for entry in entries
+                   if snapshot.get(entry.identifier) is not None and entry.views is not None
+                   and entry.views != snapshot[entry.identifier]}
+    removed = sorted(identifier for identifier in snapshot if identifier not in listed)
+
+    highest = max(listed) if len(listed) > 0 else None
+    if high_water_mark is not None and (highest is None or highest < high_water_mark):
+        highest = high_water_mark
+
+    truncated = high_water_mark is not None and len(entries) >= HISTORY_PAGE_SIZE and min(listed) > high_water_mark
+
+    return SyncResult(entries, new_entries, view_deltas, removed, highest, truncated)
+
+
+def known_entries(list_func=get_history):
+    """
+    Lists the newest entries, along with every not yet deleted entry a previous run has journaled,
+    as the history API only ever lists the newest entries.
+    :param list_func:   Returns the newest entries, e.g. get_history wrapped by DeletionEngine.call.
+    :return: HistoryStore of entries.
+    """
+    entries = HistoryStore()
+    entries.update(list_func())
+
+    journal = get_journal()
+    if journal is not None:
+        entries.update(journal.pending_entries())
+
+    return entries
+
+
+def sync_history(list_func=get_history):
+    """
+    Brings the local snapshot of the account up to date with a single history request, instead of a full rescan.
+    :param list_func:   See known_entries.
+    :return: SyncResult
+    """
+    journal = get_journal()
+    if journal is None:
+        raise Exception("Syncing needs the journal, but journal_enabled is off in config!")
+
+    high_water_mark = journal.high_water_mark()
+    entries = list_func()
+    lowest = min(entry.identifier for entry in entries) if len(entries) > 0 else None
+
+    result = diff_snapshot(entries, journal.snapshot_views(lowest), high_water_mark)
+    journal.record_snapshot(entries, result.removed, result.high_water_mark)
+
+    log.info("Synced: %d new, %d view changes, %d removed, high-water mark %s -> %s", len(result.new_entries),
+             len(result.view_deltas), len(result.removed), high_water_mark, result.high_water_mark)
+
+    return result
+
+
+def print_sync(result: SyncResult):
+    logprint("Sync: {} new entries, {} with changed view counts, {} gone, high-water mark at {}.".format(
+        len(result.new_entries), len(result.view_deltas), len(result.removed), result.high_water_mark))
+
+    for entry in result.new_entries:
+        logprint("  new {} {} ({} views)".format(entry.identifier, entry.filename, entry.views))
+
+    for identifier, delta in sorted(result.view_deltas.items()):
+        logprint("  {} {:+d} views".format(identifier, delta))
+
+    if result.truncated:
+        logprint_error("Warning: history only lists the newest {} entries, and they're all new, so there may be "
+                       "more new entries. They show up in later syncs as the newer ones are deleted.".format(
+                           HISTORY_PAGE_SIZE))
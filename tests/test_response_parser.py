@@ -0,0 +1,130 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from puush_entry import PuushEntry
+from response_parser import AuthInfo, ResponseParseError, UploadResult, iter_history_entries, iter_lines, \
+    parse_auth_response, parse_history_line, parse_history_lines, parse_upload_response, split_status
+
+SEEDS = range(20)
+
+# Bytes that make up the interesting parts of a response, weighted towards separators.
+ALPHABET = b"0123456789,,,,-:. \n\n\r\xff\xfeaZ/"
+
+
+def random_blob(rng: random.Random, max_size: int = 512):
+    if rng.random() < 0.5:
+        return bytes(rng.getrandbits(8) for _ in range(rng.randrange(max_size)))
+
+    return bytes(rng.choice(ALPHABET) for _ in range(rng.randrange(max_size)))
+
+
+def random_filename(rng: random.Random):
+    characters = "abcXYZ019 ._-,,()[]'\"æøå"
+
+    return "".join(rng.choice(characters) for _ in range(rng.randrange(1, 40)))
+
+
+def random_entry(rng: random.Random):
+    return PuushEntry(rng.randrange(1, 10 ** 10),
+                      datetime(2010, 1, 1) + timedelta(seconds=rng.randrange(10 ** 9)),
+                      "https://puu.sh/{}.png".format(rng.randrange(10 ** 6)),
+                      random_filename(rng),
+                      rng.randrange(10 ** 6),
+                      str(rng.randrange(2)))
+
+
+def history_line(entry: PuushEntry):
+    return "{},{},{},{},{},{}".format(entry.identifier, entry.date.strftime("%Y-%m-%d %H:%M:%S"), entry.url,
+                                      entry.filename, entry.views, entry.unknown)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_random_blobs_only_raise_parse_errors(seed):
+    rng = random.Random(seed)
+
+    for _ in range(200):
+        blob = random_blob(rng)
+
+        status_code, start = split_status(blob)
+        assert isinstance(status_code, str)
+        assert 0 <= start <= len(blob)
+
+        for entry in iter_history_entries(blob, start):
+            assert isinstance(entry, PuushEntry)
+
+        text = blob.decode("utf-8", errors="replace")
+
+        for parse in (parse_history_line, parse_auth_response, parse_upload_response):
+            try:
+                parse(text)
+            except ResponseParseError:
+                pass
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_history_lines_round_trip(seed):
+    rng = random.Random(seed)
+    entries = [random_entry(rng) for _ in range(50)]
+    content = ("0\n" + "".join(history_line(entry) + "\n" for entry in entries)).encode("utf-8")
+
+    status_code, start = split_status(content)
+
+    assert status_code == "0"
+    assert list(iter_history_entries(content, start)) == entries
+
+
+def test_filename_with_commas():
+    entry = parse_history_line("42,2020-01-02 03:04:05,https://puu.sh/a.png,a, b,,c.png,7,0")
+
+    assert entry == PuushEntry(42, datetime(2020, 1, 2, 3, 4, 5), "https://puu.sh/a.png", "a, b,,c.png", 7, "0")
+
+
+@pytest.mark.parametrize("line", ["", "42", "42,2020-01-02 03:04:05,url", "x,2020-01-02 03:04:05,url,f,1,0",
+                                  "42,yesterday,url,f,1,0", "42,2020-01-02 03:04:05,url,f,many,0"])
+def test_malformed_history_line(line):
+    with pytest.raises(ResponseParseError):
+        parse_history_line(line)
+
+
+def test_malformed_history_lines_are_skipped():
+    lines = ["1,2020-01-02 03:04:05,url,f,1,0", "garbage", "", "2,2020-01-02 03:04:05,url,g,2,0"]
+
+    assert [entry.identifier for entry in parse_history_lines(lines)] == [1, 2]
+
+
+def test_iter_lines_strips_line_endings():
+    assert list(iter_lines(b"0\r\na\r\n\nb", 3)) == ["a", "b"]
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("1,abcdef,,12345", ("0", AuthInfo(True, "abcdef", None, 12345))),
+    ("0,abcdef,2030-01-01 00:00:00,0\n", ("0", AuthInfo(False, "abcdef", "2030-01-01 00:00:00", 0))),
+    ("-1", ("-1", None)),
+    ("-2\n", ("-2", None)),
+])
+def test_parse_auth_response(text, expected):
+    assert parse_auth_response(text) == expected
+
+
+@pytest.mark.parametrize("text", ["1,abcdef", "1,abcdef,,lots"])
+def test_malformed_auth_response(text):
+    with pytest.raises(ResponseParseError):
+        parse_auth_response(text)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("0,https://puu.sh/a.png,123,456", ("0", UploadResult("https://puu.sh/a.png", 123, 456))),
+    ("0,https://puu.sh/a,b.png,123,456\n", ("0", UploadResult("https://puu.sh/a,b.png", 123, 456))),
+    ("-1", ("-1", None)),
+    ("-3", ("-3", None)),
+])
+def test_parse_upload_response(text, expected):
+    assert parse_upload_response(text) == expected
+
+
+@pytest.mark.parametrize("text", ["0", "0,https://puu.sh/a.png", "0,https://puu.sh/a.png,id,456"])
+def test_malformed_upload_response(text):
+    with pytest.raises(ResponseParseError):
+        parse_upload_response(text)
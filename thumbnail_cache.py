@@ -0,0 +1,251 @@
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+from handlers.config_handler import get_option
+from handlers.log_handler import create_logger
+from puush_api import get_history, get_thumbnail
+from settings import THUMBNAIL_PACK_PATH
+from sync import known_entries
+from utils import logprint
+
+log = create_logger(__name__)
+
+THUMBNAIL_CACHE = None
+THUMBNAIL_CACHE_LOCK = threading.Lock()
+
+# Pack file layout: magic, then records of [int64 identifier][uint32 length][PNG bytes].
+# A record with length 0 means the entry has no thumbnail.
+PACK_MAGIC = b"PSHTHM1\n"
+RECORD_HEADER = struct.Struct("<qI")
+
+
+class ThumbnailCache:
+    """
+    Two-tier thumbnail cache: an in-memory LRU bounded by bytes, backed by a single append-only pack file on disk.
+
+    The pack file is memory-mapped for reads and indexed by identifier when opened, so that cached thumbnails
+    of large accounts cost neither a request nor a file of their own.
+    """
+    def __init__(self, pack_path=THUMBNAIL_PACK_PATH, memory_limit: int = 32 * 1024 * 1024, fetch=get_thumbnail):
+        """
+        :param pack_path:
+        :param memory_limit:    Maximum amount of thumbnail bytes held in memory.
+        :param fetch:           Callable that fetches the thumbnail of an identifier, or returns None.
+        """
+        self.memory_limit = memory_limit
+        self.fetch = fetch
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.offsets = {}
+        self.map = None
+
+        new_file = not os.path.isfile(pack_path) or os.path.getsize(pack_path) == 0
+        self.file = open(pack_path, 'r+b' if not new_file else 'w+b')
+
+        if new_file:
+            self.file.write(PACK_MAGIC)
+            self.file.flush()
+        else:
+            self._load_index(pack_path)
+
+    def _load_index(self, pack_path):
+        """
+        Indexes the records of an existing pack file, dropping a trailing record that a crash left incomplete.
+        :param pack_path:
+        :return:
+        """
+        self._remap()
+
+        if self.map[:len(PACK_MAGIC)] != PACK_MAGIC:
+            raise ValueError("{} is not a thumbnail pack file!".format(pack_path))
+
+        offset = len(PACK_MAGIC)
+        end = len(self.map)
+
+        while offset + RECORD_HEADER.size <= end:
+            identifier, length = RECORD_HEADER.unpack_from(self.map, offset)
+
+            if offset + RECORD_HEADER.size + length > end:
+                break
+
+            self.offsets[identifier] = (offset + RECORD_HEADER.size, length)
+            offset += RECORD_HEADER.size + length
+
+        if offset < end:
+            log.warning("Dropping %d bytes of incomplete records from %s", end - offset, pack_path)
+            self.map.close()
+            self.map = None
+            self.file.truncate(offset)
+
+        log.info("Indexed %d cached thumbnails in %s", len(self.offsets), pack_path)
+
+    def _remap(self):
+        """
+        Maps the whole pack file, including records appended since it was last mapped.
+
+        Must be called with the lock held (or before the cache is shared).
+        :return:
+        """
+        if self.map is not None:
+            self.map.close()
+
+        self.file.flush()
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _remember(self, identifier: int, thumbnail: bytes):
+        """
+        Adds a thumbnail to the in-memory LRU, evicting the least recently used ones to stay within the limit.
+
+        Must be called with the lock held.
+        :param identifier:
+        :param thumbnail:
+        :return:
+        """
+        if identifier in self.memory:
+            self.memory_size -= len(self.memory.pop(identifier) or b"")
+
+        self.memory[identifier] = thumbnail
+        self.memory_size += len(thumbnail or b"")
+
+        while self.memory_size > self.memory_limit and len(self.memory) > 1:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_size -= len(evicted or b"")
+
+    def _lookup(self, identifier: int):
+        """
+        Must be called with the lock held.
+        :param identifier:
+        :return: (whether the thumbnail is cached, thumbnail or None)
+        """
+        if identifier in self.memory:
+            self.memory.move_to_end(identifier)
+            return True, self.memory[identifier]
+
+        if identifier in self.offsets:
+            offset, length = self.offsets[identifier]
+
+            if self.map is None or offset + length > len(self.map):
+                self._remap()
+
+            thumbnail = self.map[offset:offset + length] if length > 0 else None
+            self._remember(identifier, thumbnail)
+
+            return True, thumbnail
+
+        return False, None
+
+    def _store(self, identifier: int, thumbnail):
+        """
+        Appends a thumbnail (or the lack of one) to the pack file.
+        :param identifier:
+        :param thumbnail:
+        :return:
+        """
+        data = thumbnail or b""
+
+        with self.lock:
+            offset = self.file.seek(0, os.SEEK_END)
+            self.file.write(RECORD_HEADER.pack(identifier, len(data)) + data)
+
+            self.offsets[identifier] = (offset + RECORD_HEADER.size, len(data))
+            self._remember(identifier, thumbnail)
+
+    def __contains__(self, identifier):
+        with self.lock:
+            return int(identifier) in self.memory or int(identifier) in self.offsets
+
+    def get(self, identifier: int):
+        """
+        :param identifier:
+        :return: PNG bytes of the entry's thumbnail, or None if it has none. Only fetched if not cached.
+        """
+        identifier = int(identifier)
+
+        with self.lock:
+            cached, thumbnail = self._lookup(identifier)
+
+        if cached:
+            return thumbnail
+
+        thumbnail = self.fetch(identifier)
+        self._store(identifier, thumbnail)
+
+        return thumbnail
+
+    def prefetch(self, identifiers, map_func=map):
+        """
+        Fetches the thumbnails that aren't cached yet in one batch, e.g. for a whole history page.
+        :param identifiers:
+        :param map_func:    Calls a function for every item, e.g. DeletionEngine.map, to fetch concurrently.
+        :return: Amount of fetched thumbnails.
+        """
+        missing = [int(identifier) for identifier in dict.fromkeys(identifiers) if identifier not in self]
+
+        for _ in map_func(self.get, missing):
+            pass
+
+        return len(missing)
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+
+            self.file.close()
+
+
+def get_thumbnail_cache():
+    """
+    Returns *the* (singular) thumbnail cache, opening it on first use.
+    :return:
+    """
+    global THUMBNAIL_CACHE
+
+    with THUMBNAIL_CACHE_LOCK:
+        if THUMBNAIL_CACHE is None:
+            THUMBNAIL_CACHE = ThumbnailCache(
+                memory_limit=get_option("thumbnail_cache_memory_bytes", default=32 * 1024 * 1024))
+
+    return THUMBNAIL_CACHE
+
+
+def close_thumbnail_cache():
+    global THUMBNAIL_CACHE
+
+    with THUMBNAIL_CACHE_LOCK:
+        if THUMBNAIL_CACHE is not None:
+            THUMBNAIL_CACHE.close()
+            THUMBNAIL_CACHE = None
+
+
+def prefetch_thumbnails(engine, list_func=get_history, page_size: int = 100):
+    """
+    Caches the thumbnail of every known entry (the newest entries and those journaled by previous runs),
+    one page at a time, so that reviewing them later doesn't cost a request per thumbnail.
+    :param engine:      DeletionEngine, which rate limits (and retries) the thumbnail requests.
+    :param list_func:   See sync.known_entries.
+    :param page_size:
+    :return: Amount of fetched thumbnails.
+    """
+    entries = known_entries(list_func)
+    cache = get_thumbnail_cache()
+    identifiers = [entry.identifier for entry in entries]
+    fetched = 0
+
+    for start in range(0, len(identifiers), page_size):
+        fetched += cache.prefetch(identifiers[start:start + page_size], map_func=engine.map)
+        cache.flush()
+
+    logprint("Fetched {} thumbnails, {} of {} entries were already cached.".format(
+        fetched, len(identifiers) - fetched, len(identifiers)))
+
+    return fetched
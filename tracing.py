@@ -0,0 +1,206 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import nullcontext
+
+from handlers.log_handler import create_logger
+
+log = create_logger(__name__)
+
+# Callables that are handed every finished span as (name, category, start, duration, args),
+# with start and duration in seconds on the time.perf_counter clock.
+SPAN_HOOKS = []
+
+# Returned by span() when nothing listens, so that untraced runs don't pay for timing.
+NO_SPAN = nullcontext()
+
+
+def emit_span(name: str, category: str, start: float, duration: float, args: dict = None):
+    """
+    Hands a finished span to every hook, e.g. for phases that are only known after the fact.
+    :param name:
+    :param category:
+    :param start:       time.perf_counter() at the start of the span.
+    :param duration:    Seconds.
+    :param args:        Extra information shown with the span.
+    :return:
+    """
+    for hook in SPAN_HOOKS:
+        hook(name, category, start, duration, args or {})
+
+
+def emit_response_spans(endpoint: str, start: float, response):
+    """
+    Splits a finished (not streamed) request into the time until the response headers were parsed
+    (connecting, TLS and server time) and the time spent reading the body.
+    :param endpoint:
+    :param start:       time.perf_counter() before the request was sent.
+    :param response:    requests.Response
+    :return:
+    """
+    total = time.perf_counter() - start
+    headers = min(response.elapsed.total_seconds(), total)
+
+    emit_span("wait for response", "network", start, headers, {"endpoint": endpoint})
+    emit_span("read body", "network", start + headers, total - headers,
+              {"endpoint": endpoint, "bytes": len(response.content)})
+
+
+class Span:
+    def __init__(self, name: str, category: str, args: dict):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+
+        emit_span(self.name, self.category, self.start, time.perf_counter() - self.start, self.args)
+
+
+def span(name: str, category: str, **args):
+    """
+    Times the enclosed block as a span, if any hook is registered.
+    :param name:
+    :param category:    Groups spans by phase, e.g. "http", "parse", "throttle".
+    :param args:        Extra information shown with the span.
+    :return: Context manager.
+    """
+    if len(SPAN_HOOKS) == 0:
+        return NO_SPAN
+
+    return Span(name, category, args)
+
+
+class TraceWriter:
+    """
+    Collects spans and writes them as a Chrome trace (JSON object format),
+    which chrome://tracing, Perfetto and speedscope can open.
+    """
+    def __init__(self, trace_path: str):
+        """
+        :param trace_path:
+        """
+        self.trace_path = trace_path
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+        self.events = []
+        self.lock = threading.Lock()
+
+    def __call__(self, name: str, category: str, start: float, duration: float, args: dict):
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": round((start - self.origin) * 1e6, 1),
+            "dur": round(duration * 1e6, 1),
+            "pid": self.pid,
+            "tid": threading.get_ident(),
+            "args": args
+        }
+
+        with self.lock:
+            self.events.append(event)
+
+    def thread_names(self):
+        """
+        :return: Metadata events naming the threads, so worker threads are labelled in the trace viewer.
+        """
+        return [{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": thread.ident,
+                 "args": {"name": thread.name}} for thread in threading.enumerate()]
+
+    def close(self):
+        with self.lock:
+            events = self.thread_names() + self.events
+
+        tmp_path = "{}.tmp".format(self.trace_path)
+
+        with open(tmp_path, 'w') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, separators=(",", ":"))
+
+        os.replace(tmp_path, self.trace_path)
+        log.info("Wrote %d spans to %s", len(events), self.trace_path)
+
+
+def start_tracing(trace_path: str):
+    """
+    :param trace_path:
+    :return: TraceWriter, registered as a span hook.
+    """
+    writer = TraceWriter(trace_path)
+    SPAN_HOOKS.append(writer)
+
+    return writer
+
+
+def stop_tracing(writer: TraceWriter):
+    SPAN_HOOKS.remove(writer)
+    writer.close()
+
+
+# Since Python 3.12, cProfile is built on sys.monitoring, which sees every thread but allows only one active profiler.
+PROFILE_ALL_THREADS = sys.version_info >= (3, 12)
+
+
+class Profiler:
+    """
+    Up to Python 3.11, cProfile only profiles the thread that enables it, so this also profiles every thread started
+    while it is running (e.g. deletion workers) and merges their stats when stopped.
+    """
+    def __init__(self, profile_path: str):
+        """
+        :param profile_path:    Where to dump the merged stats, in pstats format (e.g. for snakeviz).
+        """
+        self.profile_path = profile_path
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def _new_profile(self):
+        # cProfile takes a while to import, so only profiled runs pay for it.
+        import cProfile
+
+        profile = cProfile.Profile()
+
+        with self.lock:
+            self.profiles.append(profile)
+
+        return profile
+
+    def _profile_thread(self, frame, event, arg):
+        # Called (as the profile function) on the first event of a new thread, replace it with cProfile's.
+        self._new_profile().enable()
+
+    def start(self):
+        if not PROFILE_ALL_THREADS:
+            threading.setprofile(self._profile_thread)
+
+        self._new_profile().enable()
+
+        return self
+
+    def stop(self):
+        import pstats
+
+        if not PROFILE_ALL_THREADS:
+            threading.setprofile(None)
+
+        with self.lock:
+            profiles = list(self.profiles)
+
+        # Disabling only affects the calling thread, the workers have finished by now.
+        profiles[0].disable()
+        stats = pstats.Stats(*profiles)
+        stats.dump_stats(self.profile_path)
+
+        log.info("Wrote profile of %s threads to %s", "all" if PROFILE_ALL_THREADS else len(profiles),
+                 self.profile_path)
+
+        return stats
@@ -0,0 +1,241 @@
+import asyncio
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple, Optional
+
+from async_api_client import AsyncPuushApiClient, call_async, is_transient_async_error
+from handlers.config_handler import get_option
+from handlers.log_handler import create_logger
+from handlers.rate_limit_handler import TokenBucket
+from puush_api import PuushApiError
+from settings import UPLOAD_MANIFEST_PATH
+from utils import logprint, logprint_error
+
+log = create_logger(__name__)
+
+# Status code returned by the upload API when the uploaded file doesn't match the given MD5 hash.
+HASH_MISMATCH_STATUS_CODE = "-3"
+
+
+class UploadTask(NamedTuple):
+    path: str
+    md5: str
+    size: int
+
+
+class ManifestEntry(NamedTuple):
+    path: str
+    md5: str
+    size: int
+    url: Optional[str]
+    identifier: Optional[int]
+    error: Optional[str] = None
+
+
+def walk_files(root: str):
+    """
+    :param root:
+    :return: Paths of all files in the directory tree, in a stable order.
+    """
+    paths = []
+
+    for directory, directories, filenames in os.walk(root):
+        directories.sort()
+        paths.extend(os.path.join(directory, filename) for filename in sorted(filenames))
+
+    return paths
+
+
+def hash_file(path: str, chunk_size: int = 1024 * 1024):
+    """
+    Hashes a file in chunks, without reading it into memory.
+    :param path:
+    :param chunk_size:
+    :return: UploadTask
+    """
+    md5 = hashlib.md5()
+    size = 0
+
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+
+            md5.update(chunk)
+            size += len(chunk)
+
+    return UploadTask(path, md5.hexdigest(), size)
+
+
+def hash_files(paths: list, workers: int = None):
+    """
+    Hashes files on a process pool, as MD5 is CPU bound and a thread pool would be serialized by the GIL.
+    :param paths:
+    :param workers: Amount of processes, defaults to the amount of CPUs.
+    :return: List of UploadTask, in the order of paths.
+    """
+    if len(paths) == 0:
+        return []
+
+    # Hand out paths in batches, so small files don't cost an inter-process round trip each.
+    chunksize = max(1, len(paths) // (4 * (workers or os.cpu_count() or 1)))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(hash_file, paths, chunksize=chunksize))
+
+
+def load_manifest(manifest_path=UPLOAD_MANIFEST_PATH):
+    """
+    :param manifest_path:
+    :return: dict of path: ManifestEntry of a previous run, if any.
+    """
+    if not os.path.isfile(manifest_path):
+        return {}
+
+    manifest = {}
+
+    with open(manifest_path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+
+            try:
+                entry = ManifestEntry(**json.loads(line))
+            except ValueError:
+                # A run killed while appending leaves an incomplete last line, that file is simply uploaded again.
+                log.warning("Skipping incomplete manifest line: %r", line)
+                continue
+
+            # Entries are appended as uploads finish, so later lines supersede earlier ones.
+            manifest[entry.path] = entry
+
+    return manifest
+
+
+def save_manifest(entries, manifest_path=UPLOAD_MANIFEST_PATH):
+    """
+    Atomically writes the manifest, one JSON object per uploaded (or failed) file.
+    :param entries: Iterable of ManifestEntry.
+    :param manifest_path:
+    :return:
+    """
+    tmp_path = "{}.tmp".format(manifest_path)
+
+    with open(tmp_path, 'w') as f:
+        for entry in entries:
+            f.write(json.dumps(entry._asdict(), ensure_ascii=False) + "\n")
+
+    os.replace(tmp_path, manifest_path)
+
+
+async def upload_task(client: AsyncPuushApiClient, task: UploadTask, rate_limiter: TokenBucket, max_retries: int = 0):
+    """
+    Uploads a file, retrying transient errors and hash mismatches.
+
+    A hash mismatch means the file changed since it was hashed, or got corrupted on the way,
+    so the file is hashed again before retrying.
+    :param client:
+    :param task:
+    :param rate_limiter:
+    :param max_retries:
+    :return: ManifestEntry
+    """
+    async def upload(path):
+        nonlocal task
+
+        try:
+            return await client.upload(path, md5=task.md5)
+        except PuushApiError as exc:
+            if exc.status_code == HASH_MISMATCH_STATUS_CODE:
+                task = await asyncio.get_running_loop().run_in_executor(None, hash_file, path)
+            raise
+
+    def is_retryable(exc):
+        return is_transient_async_error(exc) or \
+            (isinstance(exc, PuushApiError) and exc.status_code == HASH_MISMATCH_STATUS_CODE)
+
+    try:
+        result = await call_async(rate_limiter, upload, task.path, max_retries=max_retries, is_retryable=is_retryable)
+    except Exception as exc:
+        logprint_error("Failed to upload {}: {}".format(task.path, exc))
+
+        return ManifestEntry(task.path, task.md5, task.size, None, None, str(exc))
+
+    logprint("Uploaded {} to {}.".format(task.path, result.url))
+
+    return ManifestEntry(task.path, task.md5, result.size, result.url, result.identifier)
+
+
+async def upload_tasks(tasks: list, rate_limiter: TokenBucket, max_retries: int = 0, api_key: str = None,
+                       on_uploaded=None):
+    """
+    Uploads files concurrently through a single pooled client, with up to async_concurrency uploads in flight.
+    :param tasks:
+    :param rate_limiter:
+    :param max_retries:
+    :param api_key:
+    :param on_uploaded: Called with the ManifestEntry of every file as soon as its upload finishes (or fails).
+    :return: List of ManifestEntry.
+    """
+    concurrency = get_option("async_concurrency", default=100)
+
+    # The client only bounds requests in flight, this also bounds the amount of files held open.
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def upload(task):
+        async with semaphore:
+            entry = await upload_task(client, task, rate_limiter, max_retries)
+
+        if on_uploaded is not None:
+            on_uploaded(entry)
+
+        return entry
+
+    async with AsyncPuushApiClient(api_key=api_key, concurrency=concurrency,
+                                   timeout=get_option("upload_timeout_seconds", default=600)) as client:
+        return await asyncio.gather(*(upload(task) for task in tasks))
+
+
+def upload_directory(root: str, rate_limiter: TokenBucket, max_retries: int = 0, manifest_path=UPLOAD_MANIFEST_PATH):
+    """
+    Uploads every file in a directory tree, and writes a manifest of their URLs and IDs.
+
+    Every upload is appended to the manifest as soon as it finishes, and files that an existing manifest lists as
+    uploaded are skipped, so an interrupted upload can simply be rerun. The manifest is rewritten once done.
+    :param root:
+    :param rate_limiter:
+    :param max_retries:
+    :param manifest_path:
+    :return: List of ManifestEntry of this run.
+    """
+    manifest = load_manifest(manifest_path)
+    paths = [path for path in walk_files(root) if path not in manifest or manifest[path].url is None]
+
+    uploaded = sum(1 for entry in manifest.values() if entry.url is not None)
+    logprint("Hashing {} files ({} already uploaded)...".format(len(paths), uploaded))
+    tasks = hash_files(paths, workers=get_option("upload_hash_workers", default=None))
+
+    # Start from a clean copy, in case a killed run left an incomplete line to append to.
+    save_manifest(manifest.values(), manifest_path)
+
+    logprint("Uploading {} files ({} bytes)...".format(len(tasks), sum(task.size for task in tasks)))
+
+    with open(manifest_path, 'a') as f:
+        def append_to_manifest(entry):
+            f.write(json.dumps(entry._asdict(), ensure_ascii=False) + "\n")
+            f.flush()
+
+        results = asyncio.run(upload_tasks(tasks, rate_limiter, max_retries=max_retries,
+                                           on_uploaded=append_to_manifest))
+
+    manifest.update((entry.path, entry) for entry in results)
+    save_manifest(manifest.values(), manifest_path)
+
+    failed = sum(1 for entry in results if entry.url is None)
+    logprint("Uploaded {} files, {} failed. Manifest written to {}.".format(len(results) - failed, failed,
+                                                                           manifest_path))
+
+    return results
@@ -1,50 +1,66 @@
 from __future__ import print_function
+import logging
 import sys
-from requests import Response
+from typing import TYPE_CHECKING
 
+from handlers.config_handler import get_option
 from handlers.log_handler import create_logger
 
+if TYPE_CHECKING:
+    from requests import Response
+
 log = create_logger(__name__)
 
 
+def format_request(url: str, method="POST"):
+    return "Sent {method} request to {url}".format(method=method, url=url)
+
+
+def format_response(response: 'Response'):
+    return "Received {method} request response {code} ({reason}){server} " \
+           "in {elapsed}".format(
+                method=response.request.method.upper(),
+                server=" from server '{}'".format(
+                    response.headers.get("Server")) if "Server" in response.headers.keys() else "",
+                elapsed=str(response.elapsed),
+                reason=response.reason,
+                code=response.status_code)
+
+
 def log_request(url: str, method="POST"):
-    log.info("Sent {method} request to {url}".format(method=method, url=url))
+    log.info("Sent %s request to %s", method, url)
 
 
 def print_request(url: str, method="POST"):
-    print("Sent {method} request to {url}".format(method=method, url=url))
+    print(format_request(url, method))
 
 
 def logprint_request(url: str, method="POST"):
     log_request(url, method)
-    print_request(url, method)
 
+    # Print every request and response to stdout (they're always logged at INFO level).
+    if get_option("print_requests", default=False):
+        print_request(url, method)
 
-def log_response(response: Response):
-    log.info("Received {method} request response {code} ({reason}){server} "
-             "in {elapsed}".format(
-                method=response.request.method.upper(),
-                server=" from server '{}'".format(
-                    response.headers.get("Server")) if "Server" in response.headers.keys() else "",
-                elapsed=str(response.elapsed),
-                reason=response.reason,
-                code=response.status_code))
 
+def log_response(response: 'Response'):
+    # Only describe the response if it is actually going to be logged.
+    if log.isEnabledFor(logging.INFO):
+        log.info(format_response(response))
+
+
+def print_response(response: 'Response'):
+    print(format_response(response))
 
-def print_response(response: Response):
-    print("Received {method} request response {code} ({reason}){server} "
-          "in {elapsed}".format(
-                method=response.request.method.upper(),
-                server=" from server '{}'".format(
-                    response.headers.get("Server")) if "Server" in response.headers.keys() else "",
-                elapsed=str(response.elapsed),
-                reason=response.reason,
-                code=response.status_code))
 
+def logprint_response(response: 'Response'):
+    if not get_option("print_requests", default=False):
+        return log_response(response)
 
-def logprint_response(response: Response):
-    log_response(response)
-    print_response(response)
+    # Format the message once for both destinations.
+    message = format_response(response)
+    log.info(message)
+    print(message)
 
 
 def logprint(*args, **kwargs):
@@ -58,4 +74,4 @@ def eprint(*args, **kwargs):
 
 def logprint_error(*args, **kwargs):
     log.error(*args, **kwargs)
-    eprint(*args, **kwargs)
\ No newline at end of file
+    eprint(*args, **kwargs)